@@ -1,16 +1,26 @@
 import Metashape
 import argparse
 from pprint import pprint
-from collections import defaultdict
-import os, sys, time, re
+import os, sys, time
 import configparser
+import cProfile
 from datetime import datetime
+from contextlib import contextmanager
 
 from metashape_util.chunk import ChunkUtils
 from metashape_util.dialog import Dialog 
 from metashape_util.file_utils import  FileUtils
 from metashape_util.stats import  Stats
 from metashape_util.email_notify import EmailNotify
+from metashape_util.import_manifest import ImportManifest
+from metashape_util.stage_journal import StageJournal
+from metashape_util.stage_metrics import StageMetrics
+from metashape_util.progress_status import ProgressStatus
+from metashape_util.cog_export import CogExport
+from metashape_util.profiles import ProcessingProfiles
+from metashape_util.image_culling import ImageCulling
+from metashape_util.photo_index import PhotoIndex
+from metashape_util.overlap_graph import OverlapGraph
 
 from gcp_detector.gcpToMarker import GcpToMarker
  
@@ -21,7 +31,6 @@ from gcp_detector.gcpToMarker import GcpToMarker
 app = Metashape.Application()
 doc = app.document
 dialog = Dialog(app)
-gcpToMarker = GcpToMarker()
 
 # Config parser - read config.ini
 config = configparser.ConfigParser()
@@ -34,6 +43,26 @@ notify = EmailNotify(config["EmailNotify"])
 start_time = datetime.now()
 
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--import-new', dest='import_new', type=bool, help='Work with existing chunks or import new data')
+parser.add_argument('--recpath', dest='records_path', type=str, help='Directory to scan for records')
+parser.add_argument('--import-only', dest='import_only', type=bool, help='Only creates the chunks and basic camera aligning, no processing', default=False)
+parser.add_argument('--refpath', dest='reference_path', type=str, help='Path to file containing GCP references')
+parser.add_argument('--year', dest='year', type=str, help='Year of records to import, read from folder name')
+parser.add_argument('--field', dest='field', type=str, help='Field to import, must match folder name')
+parser.add_argument('--invalidate', dest='invalidate', action='append', default=[], help='Run a stage and all following stages again: [stage] or [chunk label]:[stage], stages: ' + ", ".join(StageJournal.STAGES))
+parser.add_argument('--detections', dest='detections_path', type=str, help='GCP detection file of gcp_detector/detectRecords.py, pins markers without detecting again')
+parser.add_argument('--project', dest='project_path', type=str, help='Project file to process, opened or created (for unattended runs, see 3_batchAutoDEM.py)')
+parser.add_argument('--quit', dest='quit', action='store_true', help='Close Metashape when the script ended or failed (for unattended runs)')
+args = parser.parse_args()
+
+# Unattended runs open or create the project given by --project
+if(args.project_path):
+	if(os.path.exists(args.project_path)):
+		doc.open(args.project_path)
+	else:
+		doc.save(args.project_path)
+
 # Save the document before starting
 # The "Save As.." Dialog is not working from the Python API 
 # if the document is not saved already somewhere document.save() thorws an error
@@ -43,15 +72,24 @@ except OSError:
 	raise Exception("Error while trying to save the project file. \r\n Please chose \"save as\" and save project under a memoriable name in a proper location.")
 
 documentFile = FileUtils.parsePath(doc.path)
+notify.project = documentFile['name']
 
 def except_hook(type, value, tback):
+    # The values collected so far are exported too
+    if("stats" in globals()):
+        stats.saveFile()
+    if("status" in globals()):
+        status.finish("failed", "{}: {}".format(type.__name__, value))
     notify.exeptionHandler(documentFile['name'], type, value, tback)
     sys.__excepthook__(type, value, tback)
+    if(args.quit):
+        app.quit()
 sys.excepthook = except_hook
 
 # read global config variables
 MARKER_MAX_ERROR_METERS = config["Defaults"].getfloat("MARKER_MAX_ERROR_METERS", 0.1)
 MARKER_MIN_PINS = config["Defaults"].getint("MARKER_MIN_PINS", 0)
+GCP_PROFILE_CHUNK = config["GcpDetection"].get("GCP_PROFILE_CHUNK", "").strip()
 
 DEM_EXPORT_FOLDER = os.path.expanduser(config["Defaults"].get("DEM_EXPORT_FOLDER", "~\\Desktop\\autoDEM\\"))
 DEM_EXPORT_FOLDER += documentFile['name'] + "\\"
@@ -62,6 +100,40 @@ FileUtils.createDirsIfNotExists(DEM_EXPORT_FOLDER)
 # stats file containing metrics about task durections and chunk quality
 STATS_FILE = DEM_EXPORT_FOLDER + "stats.csv"
 stats = Stats(STATS_FILE)
+# Wall time, cpu time and peak memory of every stage of every chunk, written to the stats
+metrics = StageMetrics(stats)
+
+# Live status of the run (chunk, stage, percent, ETA) in status.json in the export folder and on a local http port
+status = ProgressStatus(DEM_EXPORT_FOLDER + "status.json" if config["Status"].getboolean("STATUS_FILE", True) else False,
+	port = config["Status"].getint("STATUS_PORT", 0),
+	host = config["Status"].get("STATUS_HOST", "127.0.0.1").strip(),
+	job = documentFile['name'])
+
+@contextmanager
+def measureStage(chunk, stage, params = None):
+	# Every stage is measured for the stats and shown in the live status
+	with metrics.measure(chunk, stage, params), status.stage(chunk, stage):
+		yield
+
+# Setup GCP detection (parallel workers are configured in config.ini)
+# Detection results are cached in the export folder, reruns skip already processed images
+gcpToMarker = GcpToMarker(config = config["GcpDetection"], cache_path = DEM_EXPORT_FOLDER + "gcp_cache.sqlite")
+
+# Journal of the finished processing stages of every chunk, a restarted script skips the finished stages
+journal = StageJournal(DEM_EXPORT_FOLDER + "stage_journal.json", save_document = doc.save, measure = measureStage)
+
+# Blurred, duplicate and takeoff / landing photos are removed before the import
+# The image features are cached in the export folder, removed photos are listed in culled_photos.csv
+culling = ImageCulling(config["ImageCulling"], cache_path = DEM_EXPORT_FOLDER + "image_features.sqlite", log_path = DEM_EXPORT_FOLDER + "culled_photos.csv")
+
+# Processing settings per chunk (sections [Profiles] and [Profile.<name>] in config.ini)
+profiles = ProcessingProfiles(config)
+
+# DEMs are exported as Cloud Optimized GeoTIFF (tiled, compressed, with overviews)
+cog = CogExport(config["Export"])
+
+# Neighbour graph of the photos from the GPS positions, used for the pair preselection and to split large chunks
+overlap = OverlapGraph(config["Matching"])
 
 # Enable log file
 LOG_FILE = DEM_EXPORT_FOLDER + time.strftime("%Y%m%d-%H%M%S") + "- log.txt"
@@ -69,14 +141,17 @@ Metashape.app.settings.log_enable = True
 Metashape.app.settings.log_path = LOG_FILE
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--import-new', dest='import_new', type=bool, help='Work with existing chunks or import new data')
-parser.add_argument('--recpath', dest='records_path', type=str, help='Directory to scan for records')
-parser.add_argument('--import-only', dest='import_only', type=bool, help='Only creates the chunks and basic camera aligning, no processing', default=False)
-parser.add_argument('--refpath', dest='reference_path', type=str, help='Path to file containing GCP references')
-parser.add_argument('--year', dest='year', type=str, help='Year of records to import, read from folder name')
-parser.add_argument('--field', dest='field', type=str, help='Field to import, must match folder name')
-args = parser.parse_args()
+
+for invalidate in args.invalidate:
+	chunk_label, _, stage = invalidate.rpartition(":")
+	if(stage not in StageJournal.STAGES):
+		raise Exception("Unknown stage: " + stage)
+	for chunk in doc.chunks:
+		if(chunk_label == "" or chunk.label == chunk_label):
+			journal.invalidate(chunk, stage)
+
+if(args.detections_path):
+	gcpToMarker.importDetections(args.detections_path)
 
 if(len(doc.chunks) <= 1):
 	import_new = True
@@ -85,6 +160,9 @@ elif(args.import_new is None):
 else:
 	import_new = args.import_new
 
+# Chunks which got new photos appended in this run, {chunk key: [new cameras]}
+appended_cameras = {}
+
 if(import_new or args.import_only):
 	# Look for the directory where the records are stored.
 	# The directory structure has to match:
@@ -101,22 +179,8 @@ if(import_new or args.import_only):
 	if(BASE_PATH.strip() == ""):
 		raise Exception("Please define a directory to scan for records")
 
-	def scan_records_dir(path): 
-		records = defaultdict(lambda: defaultdict(dict))
-		for entry in os.scandir(path):
-			if (entry.is_dir()):
-				# Regex checks subdir names and excludes malformatted and "Kalibrierung" / "Kalibartion"
-				match_pattern = re.match(r"(\d{4}\-\d{2}\-\d{2})[\s\_]((?!Kal).+$)", entry.name, re.IGNORECASE) 
-				if (match_pattern):
-					entry_name = match_pattern.group(2)
-					entry_date = match_pattern.group(1)
-					entry_year = entry_date[:4]
-					
-					records[entry_year][entry_name][entry_date] = entry.path # records[name] = date
-		return dict(records)
-		
 	# Read all records from specified directory
-	avaliable_records = scan_records_dir(BASE_PATH)
+	avaliable_records = FileUtils.scanRecordsDir(BASE_PATH)
 
 	# Let user select year and field to import
 	# if already given by console args no dialog will open
@@ -138,40 +202,95 @@ if(import_new or args.import_only):
 		if not len(chunk.cameras):
 			doc.remove(chunk)
 
-	photos_list = {}
+	# The manifest next to the project lists the already imported photos of every chunk
+	# Only new dates get new chunks, new photos of already imported dates are appended to the existing chunk
+	manifest = ImportManifest(os.path.join(documentFile['base_folder'], documentFile['name'] + "_import.json"))
 
-	# Prompt user for file containing reference points to import in each chunk
-	ref_file = args.reference_path or app.getOpenFileName("Wähle Marker-Datei", filter="*.txt")
+	# get image pathes of all record dirs (scanned in parallel)
+	print("Scanning {} records...".format(len(records)))
+	record_files = ImportManifest.scanRecords(records)
+
+	# Index of capture time and position of all photos (EXIF / XMP header), stored in the export folder
+	# The following stages use the index instead of reading the photos again
+	photo_index = PhotoIndex(DEM_EXPORT_FOLDER + "photo_index.npz")
+	print("Indexed {} new photos".format(photo_index.update([photo for files in record_files.values() for photo in files])))
+	photo_index.save()
+
+	# Chunks are created per capture date of the photos, photos without capture time use the date of the record
+	chunk_records = [] # (date, record path, files)
+	for rec in records:
+		groups = photo_index.groupByDate(sorted(record_files[rec]), rec) if record_files[rec] else {rec: []}
+		for date, photos in groups.items():
+			if(date != rec):
+				print("Warning: {} photos of record {} were taken on {}".format(len(photos), records[rec], date))
+			chunk_records.append((date, records[rec], {photo: record_files[rec][photo] for photo in photos}))
+
+	existing_chunks = {chunk.label: chunk for chunk in doc.chunks}
+	ref_file = None
 
 	# create chunk for each date a record exists
 	print("Creating chunks...")
-	for rec in records:
-		# first create new chunk
-		chunk = doc.addChunk()
-		chunk.label = rec + "_" + field  # label is [date]_[field]
-		base_path = records[rec]
-		photos_list[rec] = []
-
-		print("Creating chunk {}".format(chunk.label))
-
-		# get image pathes from dir and save to photos_list array
-		for mission in os.scandir(base_path):
-			if(mission.is_dir() and (re.search(r"FPLAN", mission.name) or re.search(r"MEDIA", mission.name))): # only scan mission directorys for files
-				for file in os.scandir(mission.path):
-					if(file.name.rsplit(".", 1)[1].upper() in ["JPG", "JPEG"]): # only import jpg images
-						photos_list[rec].append(file.path)
-
-		# Add photos to chunk
-		if(len(photos_list[rec]) == 0):
-			print("Keine JPG-Dateien gefunden, Chunk wird deaktiviert")
-			chunk.enabled = False
-		else:	
-			print("{} Fotos gefunden, importiere in Chunk {}".format(len(photos_list[rec]), chunk.label))			
-			chunk.addPhotos(photos_list[rec])
-		
-		# Import Markers to chunks
-		if(ref_file):
-			chunk.importReference(path=ref_file, delimiter="\t", format=Metashape.ReferenceFormatCSV, columns="nxyz", create_markers=True)
+	for date, base_path, files in chunk_records:
+		label = date + "_" + field  # label is [date]_[field]
+		chunk = existing_chunks.get(label)
+
+		if(chunk is None):
+			# Prompt user for file containing reference points to import in each chunk (only once)
+			if(ref_file is None):
+				ref_file = args.reference_path or app.getOpenFileName("Wähle Marker-Datei", filter="*.txt")
+
+			# first create new chunk
+			chunk = doc.addChunk()
+			chunk.label = label
+			existing_chunks[label] = chunk
+			print("Creating chunk {}".format(chunk.label))
+
+			# Add photos to chunk
+			with measureStage(chunk, "culling"):
+				photos = culling.filterPhotos(label, sorted(files))
+			if(len(photos) == 0):
+				print("Keine JPG-Dateien gefunden, Chunk wird deaktiviert")
+				chunk.enabled = False
+			else:	
+				print("{} Fotos gefunden, importiere in Chunk {}".format(len(photos), chunk.label))			
+				with measureStage(chunk, "import_photos", {"photos": len(photos)}):
+					chunk.addPhotos(photos)
+
+			# Import Markers to chunks
+			if(ref_file):
+				with measureStage(chunk, "import_reference", {"path": ref_file}):
+					chunk.importReference(path=ref_file, delimiter="\t", format=Metashape.ReferenceFormatCSV, columns="nxyz", create_markers=True)
+		else:
+			# Existing chunk: append the photos neither in the manifest nor in the chunk
+			chunk_photos = {os.path.normcase(os.path.abspath(camera.photo.path)) for camera in chunk.cameras if camera.photo}
+			new_photos = [photo for photo in manifest.getNewPhotos(label, files)
+						  if os.path.normcase(os.path.abspath(photo)) not in chunk_photos]
+			with measureStage(chunk, "culling"):
+				new_photos = culling.filterPhotos(label, new_photos)
+			if(len(new_photos) == 0):
+				print("No new photos for chunk {}, skipping".format(label))
+			else:
+				print("{} neue Fotos gefunden, importiere in Chunk {}".format(len(new_photos), label))
+				camera_count = len(chunk.cameras)
+				with measureStage(chunk, "import_photos", {"photos": len(new_photos)}):
+					chunk.addPhotos(new_photos)
+				appended_cameras[chunk.key] = chunk.cameras[camera_count:]
+				chunk.enabled = True
+				# All stages after the import have to include the new photos
+				journal.invalidate(chunk, "match")
+
+		for reason, count in culling.lastStats.items():
+			stats.setValue(chunk, "Culling/" + reason, count)
+		if(len(files) > 0):
+			stats.setValue(chunk, "Import/flights", int(photo_index.getFlights(list(files)).max()) + 1)
+
+		# The manifest and the journal must not list photos which are not saved in the project
+		# Removed photos are listed too, they are not checked again
+		with measureStage(chunk, "save"):
+			doc.save()
+		manifest.addPhotos(label, base_path, files)
+		manifest.save()
+		journal.markDone(chunk, "import", params = {"record": base_path})
 		app.update()
 
 	doc.save()
@@ -183,32 +302,71 @@ if (args.import_only):
 # Align photos
 for chunk in list(doc.chunks):
 	if chunk.enabled == False: continue
-	if not ChunkUtils.hasChunkPointCloud(chunk):
-		chunk.matchPhotos(downscale=1, keypoint_limit=40000, tiepoint_limit=0)
-	else:
-		print("PointCloud already exists in Chunk: " + chunk.label, ", skipping")
-	if not ChunkUtils.areCamerasAligned(chunk):
-		chunk.alignCameras()
-	else:
-		print("Cameras already aligned in Chunk: " + chunk.label, ", skipping")
+	new_cameras = appended_cameras.get(chunk.key, [])
+
+	# Choose the processing profile from chunk size and free memory
+	# Chunks matched before the profiles existed were processed with the former fixed settings (= ultra)
+	# Matched chunks keep their profile, changing PROCESSING_PROFILE does not process them again (see --invalidate)
+	profile_name, profile = profiles.select(chunk, fallback = "ultra" if ChunkUtils.hasChunkPointCloud(chunk) else None,
+											keep = journal.isDone(chunk, "match"))
+	stats.setValue(chunk, "Profile/name", profile_name)
+
+	# Large new chunks are split into overlapping parts, aligned independently and merged (replaces the chunk)
+	if(overlap.needsSplit(chunk, new_cameras)):
+		journal.invalidate(chunk, "match")
+		split_start = time.time()
+		with measureStage(chunk, "align_split", profile["match"]):
+			chunk = overlap.alignSplit(doc, chunk, profile["match"], progress = status.progress)
+		stats.setValue(chunk, "Align/parts", overlap.lastParts)
+		doc.save()
+		journal.markDone(chunk, "match", params = profile["match"])
+		journal.markDone(chunk, "align", time.time() - split_start)
+		app.update()
+		continue
+
+	# Appended photos: existing matches are kept, only the new photos are matched
+	journal.run(chunk, "match",
+		lambda: overlap.matchPhotos(chunk, profile["match"], progress = status.progress),
+		params = profile["match"],
+		probe = lambda: ChunkUtils.hasChunkPointCloud(chunk))
+
+	def alignCameras():
+		if(len(new_cameras) > 0 and ChunkUtils.areCamerasAligned(chunk)):
+			chunk.alignCameras(cameras=new_cameras, reset_alignment=False, progress=status.progress)
+		else:
+			chunk.alignCameras(progress=status.progress)
+	if(journal.run(chunk, "align", alignCameras, probe = lambda: ChunkUtils.areCamerasAligned(chunk))):
+		aligned = sum(1 for camera in chunk.cameras if camera.transform)
+		notify.event(chunk, "aligned", "{} of {} cameras aligned".format(aligned, len(chunk.cameras)))
 	app.update()
 	
 # Save Project
 doc.save()
 
 # For each chunk match Ground Control Points
-# Chunks are skipped if they are disabled or have already pinned markers
+# Chunks are skipped if they are disabled or the GCP stage is already finished
 for chunk in doc.chunks:
 	if chunk.enabled == False: continue
-	if(not ChunkUtils.areMarkersPinned(chunk)):
+
+	def detectGcps():
 		print("Detecting GCPs in chunk: " + chunk.label + "...")
 		gcp_process_start = time.time()
-		gcpToMarker.processChunk(chunk)
+		# Photos appended to a processed chunk: only the new photos are searched, the pinned markers are kept
+		cameras = appended_cameras.get(chunk.key) or None
+		if(GCP_PROFILE_CHUNK != "" and chunk.label == GCP_PROFILE_CHUNK):
+			# Profile the whole GCP detection of this chunk, view the dump with e.g. snakeviz or pstats
+			profiler = cProfile.Profile()
+			profiler.runcall(gcpToMarker.processChunk, chunk, progress = status.progress, cameras = cameras, items = status.setItems)
+			profiler.dump_stats(DEM_EXPORT_FOLDER + chunk.label + ".prof")
+		else:
+			gcpToMarker.processChunk(chunk, progress = status.progress, cameras = cameras, items = status.setItems)
 		gcp_process_duration = time.time() - gcp_process_start
 		print("Finished, Operation took: " + str(gcp_process_duration) + " secounds")
 		stats.setValue(chunk, "GcpToMarker/duration", gcp_process_duration)
-	else:
-		print("Markers already pinned in Chunk: " + chunk.label, ", skipping GCP detection")
+		for key, value in gcpToMarker.chunkStats.items():
+			stats.setValue(chunk, "GcpToMarker/" + key, value)
+	# Chunks with appended photos only search the new photos, a restarted run uses the detection cache
+	journal.run(chunk, "gcp", detectGcps, probe = lambda: ChunkUtils.areMarkersPinned(chunk))
 	app.update()
 
 # Write GCP processing durations to stats file
@@ -221,12 +379,17 @@ gcp_failed_chunks = []
 for chunk in doc.chunks:
 	if chunk.enabled == False: continue
 
-	# Skip already exported chunks (check if .tif file exists)
+	# Skip already exported chunks
 	dem_export_path = DEM_EXPORT_FOLDER + chunk.label + ".tif"
-	if(os.path.exists(dem_export_path)):
-		print("DEM file already exists for chunk: " + chunk.label, ", skipping export.")
-		print("Move or delete output file to create new export.")
-		continue
+	# Chunks exported before the journal existed are found by the file like before
+	journal.adopt(chunk, "export", probe = lambda: os.path.exists(dem_export_path))
+	if(journal.isDone(chunk, "export")):
+		if(os.path.exists(dem_export_path)):
+			print("DEM file already exists for chunk: " + chunk.label, ", skipping export.")
+			print("Move or delete output file to create new export.")
+			continue
+		# The output file was removed, export again
+		journal.invalidate(chunk, "export")
 
 	# Check Error level and only continue if error level is under max value
 	# If error level is to high chunk processing is skipped
@@ -238,7 +401,7 @@ for chunk in doc.chunks:
 	for marker, count in marker_pins.items():
 		stats.setValue(chunk, "GcpToMarker/Markers/"+marker, count)
 	
-	stats.saveFile()
+	stats.commit()
 
 	# Get the Marker with the least pins
 	chunk_min_marker_pins = min(marker_pins.values())
@@ -246,65 +409,98 @@ for chunk in doc.chunks:
 	if(chunk_marker_error >= MARKER_MAX_ERROR_METERS):
 		gcp_failed_chunks.append((chunk, chunk_marker_error, chunk_min_marker_pins))
 		print("Skipping chunk " + chunk.label + " due inaccurate marker positions")
+		notify.event(chunk, "gcp_failed", "marker error {:.3f} m".format(chunk_marker_error))
 		continue
 
 	if(chunk_min_marker_pins < MARKER_MIN_PINS):
 		gcp_failed_chunks.append((chunk, chunk_marker_error, chunk_min_marker_pins))
 		print("Skipping chunk " + chunk.label + " due to few marker projections")
+		notify.event(chunk, "gcp_failed", "{} marker projections".format(chunk_min_marker_pins))
 		continue
 
+	profile_name, profile = profiles.select(chunk, fallback = "ultra", keep = journal.isDone(chunk, "match"))
+	stats.setValue(chunk, "Profile/name", profile_name)
+	# Resolutions are only passed if set, 0 keeps the default of Metashape
+	dem_params = {key: value for key, value in profile["dem"].items() if value}
+	ortho_params = {key: value for key, value in profile["ortho"].items() if value}
+
 	# Ensure that the model is optimized from GCPs
 	# Update Model
-	chunk.updateTransform()
-
-	if(len(chunk.dense_clouds) <= 0):
-		# Optimize Cameras
-		# !!!IMPORTANT this deletes all dense clouds and depth maps - only use on not already exported chunks!!
-		chunk.optimizeCameras() 
-
-		# Downscale is what is named "quality" in GUI. Where 0 - is Ultra, 1 - High, 2 - Medium, 4 - Low.
-		chunk.buildDepthMaps(
-            downscale = 1, 
-            filter_mode = Metashape.FilterMode.ModerateFiltering
-        )
-		chunk.buildDenseCloud(
-            point_colors = True
-        )
-	else:
-		print("Dense Cloud found in chunk: " + chunk.label, ", skipping")
-
-	if(len(chunk.elevations) <= 0):
-		chunk.buildDem(
+	with measureStage(chunk, "update_transform"):
+		chunk.updateTransform()
+
+	# Optimize Cameras
+	# !!!IMPORTANT this deletes all dense clouds and depth maps, the journal invalidates the following stages
+	journal.run(chunk, "optimize", lambda: chunk.optimizeCameras(progress = status.progress), probe = lambda: len(chunk.dense_clouds) > 0)
+
+	# Downscale is what is named "quality" in GUI. Where 1 - is Ultra, 2 - High, 4 - Medium, 8 - Low.
+	journal.run(chunk, "depth",
+		lambda: chunk.buildDepthMaps(
+            downscale = profile["depth"]["downscale"], 
+            filter_mode = getattr(Metashape.FilterMode, profile["depth"]["filter_mode"]),
+            progress = status.progress
+        ),
+		params = profile["depth"],
+		probe = lambda: len(chunk.dense_clouds) > 0)
+	journal.run(chunk, "dense",
+		lambda: chunk.buildDenseCloud(
+            point_colors = True,
+            progress = status.progress
+        ),
+		params = {"point_colors": True},
+		probe = lambda: len(chunk.dense_clouds) > 0)
+
+	journal.run(chunk, "dem",
+		lambda: chunk.buildDem(
 			source_data=Metashape.DenseCloudData, 
-			interpolation=Metashape.EnabledInterpolation
-        )
-	else:
-		print("Elevation Model found in chunk: " + chunk.label, ", skipping")
-
-	if(len(chunk.orthomosaics) <= 0):
-		chunk.buildOrthomosaic(
+			interpolation=Metashape.EnabledInterpolation,
+			progress=status.progress,
+			**dem_params
+        ),
+		params = dem_params,
+		probe = lambda: len(chunk.elevations) > 0)
+
+	journal.run(chunk, "ortho",
+		lambda: chunk.buildOrthomosaic(
             surface_data = Metashape.DataSource.ElevationData, 
             blending_mode = Metashape.BlendingMode.MosaicBlending, 
-            fill_holes=True
-        )
-	else:
-		print("Orthomosaic found in chunk: " + chunk.label, ", skipping")
+            fill_holes=True,
+            progress = status.progress,
+            **ortho_params
+        ),
+		params = ortho_params,
+		probe = lambda: len(chunk.orthomosaics) > 0)
 
     # Export DEM
-	chunk.exportRaster(
-		path = dem_export_path,
-		image_format = Metashape.ImageFormat.ImageFormatTIFF,
-		save_world = True,
-		source_data = Metashape.DataSource.ElevationData
-	)
+	def exportDem():
+		chunk.exportRaster(
+			path = dem_export_path,
+			image_format = Metashape.ImageFormat.ImageFormatTIFF,
+			save_world = True,
+			source_data = Metashape.DataSource.ElevationData,
+			progress = status.progress,
+			**cog.getExportParams()
+		)
+		# Rewritten with the COG layout and verified, the Metashape export is kept if this fails
+		stats.setValue(chunk, "Export/cog", cog.postprocess(dem_export_path))
+		stats.setValue(chunk, "Export/size_mb", round(os.path.getsize(dem_export_path) / 1024**2, 1))
+	journal.run(chunk, "export", exportDem)
 
 	# Save the stats file
 	stats.saveChunkMeta(chunk)
 	stats.setValue(chunk, "dem_export_path", dem_export_path)
-	stats.saveFile()
+	notify.event(chunk, "dem_exported", dem_export_path)
+	# Stage with the longest wall time in this run
+	dominant_stage, dominant_share = metrics.getDominantStage(chunk)
+	if(dominant_stage):
+		stats.setValue(chunk, "Stage/dominant", dominant_stage)
+		stats.setValue(chunk, "Stage/dominant_share", round(dominant_share, 3))
+	stats.commit()
 
 # Script ended sucessful, save
 doc.save()
+stats.saveFile()
+status.finish()
 end_time = datetime.now()			
 
 # Output a message about failed chunks which have to get corrected by hand
@@ -333,4 +529,9 @@ The exported elevation models (if any) are located in:
 print(result)
 
 # Send email notification
-notify.notify("Job finished! {}".format(documentFile['name']), result)
\ No newline at end of file
+notify.notify("Job finished! {}".format(documentFile['name']), result)
+# Waits for the queued emails (at most a minute), Metashape may quit afterwards
+notify.close()
+
+if(args.quit):
+	app.quit()
@@ -0,0 +1,189 @@
+import os, sys, csv, time, fnmatch
+import argparse
+import configparser
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from metashape_util.file_utils import FileUtils
+
+# Batch mode: runs 1_autoDEM.py unattended for many fields and years, every job in its own Metashape process
+# and project. Run this script with a normal python interpreter (not inside Metashape):
+#   python 3_batchAutoDEM.py --recpath "J:\records" --year 2023 --fields "R*" --refpath "J:\gcp\Koordinaten_GCP_{field}.txt"
+#   python 3_batchAutoDEM.py --recpath "J:\records" --jobs jobs.csv
+# jobs.csv has one job per line: year;field;refpath
+
+# Config parser - read config.ini
+config = configparser.ConfigParser()
+config.read(os.path.join(sys.path[0], "config.ini"))
+
+DEM_EXPORT_FOLDER = os.path.expanduser(config["Defaults"].get("DEM_EXPORT_FOLDER", "~\\Desktop\\autoDEM\\"))
+METASHAPE_PATH = config["Batch"].get("METASHAPE_PATH", "metashape")
+METASHAPE_ARGS = config["Batch"].get("METASHAPE_ARGS", "").split()
+PROJECT_FOLDER = os.path.expanduser(config["Batch"].get("BATCH_PROJECT_FOLDER", "~\\Desktop\\autoDEM\\projects\\"))
+BATCH_WORKERS = config["Batch"].getint("BATCH_WORKERS", 1)
+BATCH_TIMEOUT_HOURS = config["Batch"].getfloat("BATCH_TIMEOUT_HOURS", 0)
+
+# 1_autoDEM.py prints this at the end of a successful run
+SUCCESS_TEXT = "Finished job: processing aerial photos"
+
+
+def readJobs(path):
+	# Job file: year;field;refpath per line, lines starting with # are ignored
+	jobs = []
+	with open(path, newline='', encoding="utf8") as f:
+		for row in csv.reader(f, delimiter=';'):
+			if(len(row) < 3 or row[0].strip().startswith("#") or row[0].strip().lower() == "year"): continue
+			jobs.append({"year": row[0].strip(), "field": row[1].strip(), "refpath": row[2].strip()})
+	return jobs
+
+def globJobs(records, year, fields_pattern, refpath_template):
+	# One job per field of the year matching the pattern, refpath may contain {year} and {field}
+	jobs = []
+	for field in sorted(records.get(year, {})):
+		if(fnmatch.fnmatch(field, fields_pattern)):
+			jobs.append({"year": year, "field": field, "refpath": refpath_template.format(year=year, field=field)})
+	return jobs
+
+def checkJob(job, records):
+	# Errors that would open a dialog in the unattended Metashape process
+	if(job["field"] not in records.get(job["year"], {})):
+		return "No records found for year {} and field {}".format(job["year"], job["field"])
+	if(not os.path.exists(job["refpath"])):
+		return "Reference file not found: " + job["refpath"]
+	return None
+
+def jobName(job):
+	return "{}_{}".format(job["year"], FileUtils.name_escape(job["field"]))
+
+def runJob(job, records_path, script_args):
+	name = jobName(job)
+	project_path = os.path.join(PROJECT_FOLDER, name + ".psx")
+	# 1_autoDEM.py exports to a sub directory named like the project
+	export_folder = os.path.join(DEM_EXPORT_FOLDER, name)
+	FileUtils.createDirsIfNotExists(export_folder)
+	log_path = os.path.join(export_folder, "batch_" + time.strftime("%Y%m%d-%H%M%S") + ".log")
+
+	cmd = [METASHAPE_PATH] + METASHAPE_ARGS + ["-r", os.path.join(sys.path[0], "1_autoDEM.py"),
+		"--project", project_path,
+		"--recpath", records_path,
+		"--year", job["year"],
+		"--field", job["field"],
+		"--refpath", job["refpath"],
+		"--import-new", "True",
+		"--quit"] + script_args
+
+	start = time.time()
+	status = "failed"
+	with open(log_path, "w", encoding="utf8") as log:
+		log.write(" ".join(cmd) + "\n")
+		log.flush()
+		try:
+			process = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, timeout=BATCH_TIMEOUT_HOURS * 3600 or None)
+			returncode = process.returncode
+		except subprocess.TimeoutExpired:
+			returncode = None
+			status = "timeout"
+	with open(log_path, encoding="utf8", errors="replace") as log:
+		if(SUCCESS_TEXT in log.read()):
+			status = "finished"
+
+	return {
+		"job": name,
+		"year": job["year"],
+		"field": job["field"],
+		"status": status,
+		"returncode": returncode,
+		"duration": round(time.time() - start),
+		"project": project_path,
+		"export_folder": export_folder,
+		"log": log_path
+	}
+
+def writeSummary(results, path):
+	with open(path, "w", newline='', encoding="utf8") as f:
+		writer = csv.DictWriter(f, fieldnames=list(results[0].keys()), delimiter=';')
+		writer.writeheader()
+		writer.writerows(results)
+
+def mergeStats(results, path):
+	# Consolidated stats.csv of all jobs, the first column is the job name
+	rows = []
+	columns = ["Job", "Chunk Name"]
+	for result in results:
+		stats_path = os.path.join(result["export_folder"], "stats.csv")
+		if(not os.path.exists(stats_path)): continue
+		with open(stats_path, newline='', encoding="utf8", errors="replace") as f:
+			for row in csv.DictReader(f, delimiter=';'):
+				row["Job"] = result["job"]
+				rows.append(row)
+				columns += [column for column in row if column not in columns]
+	with open(path, "w", newline='', encoding="utf8") as f:
+		writer = csv.DictWriter(f, fieldnames=columns, delimiter=';')
+		writer.writeheader()
+		writer.writerows(rows)
+
+
+parser = argparse.ArgumentParser(description="Runs 1_autoDEM.py for many fields and years, every job in its own Metashape process")
+parser.add_argument('--recpath', dest='records_path', type=str, required=True, help='Directory to scan for records')
+parser.add_argument('--jobs', dest='jobs_path', type=str, help='Job file, one job per line: year;field;refpath')
+parser.add_argument('--year', dest='year', type=str, help='Year of the records to process')
+parser.add_argument('--fields', dest='fields', type=str, default="*", help='Glob pattern of the fields to process, e.g. "R*"')
+parser.add_argument('--refpath', dest='reference_path', type=str, help='Reference file of the GCPs, {year} and {field} are replaced')
+parser.add_argument('--workers', dest='workers', type=int, default=BATCH_WORKERS, help='Number of Metashape processes running at the same time')
+parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='Only list the jobs')
+args, script_args = parser.parse_known_args() # unknown arguments are passed to 1_autoDEM.py
+
+records = FileUtils.scanRecordsDir(args.records_path)
+if(args.jobs_path):
+	jobs = readJobs(args.jobs_path)
+elif(args.year and args.reference_path):
+	jobs = globJobs(records, args.year, args.fields, args.reference_path)
+else:
+	parser.error("Either --jobs or --year and --refpath are required")
+
+results = []
+queued = []
+for job in jobs:
+	error = checkJob(job, records)
+	if(error):
+		print("Skipping job {}: {}".format(jobName(job), error))
+		results.append({"job": jobName(job), "year": job["year"], "field": job["field"], "status": "skipped: " + error,
+			"returncode": None, "duration": 0, "project": "", "export_folder": "", "log": ""})
+	else:
+		queued.append(job)
+
+print("{} jobs queued, {} running at the same time".format(len(queued), args.workers))
+for job in queued:
+	print("\t" + jobName(job) + "\t" + job["refpath"])
+if(args.dry_run or len(queued) == 0):
+	sys.exit(0)
+
+FileUtils.createDirsIfNotExists(PROJECT_FOLDER)
+start_time = datetime.now()
+
+# Every job runs in its own Metashape process, the threads only wait for the processes
+with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+	futures = {pool.submit(runJob, job, args.records_path, script_args): job for job in queued}
+	for future in as_completed(futures):
+		result = future.result()
+		results.append(result)
+		print("[{}/{}] {}: {} after {} s, log: {}".format(len(results), len(jobs), result["job"], result["status"], result["duration"], result["log"]))
+
+# Summary of all jobs and consolidated stats of all chunks
+timestamp = time.strftime("%Y%m%d-%H%M%S")
+summary_path = os.path.join(DEM_EXPORT_FOLDER, "batch_summary_" + timestamp + ".csv")
+stats_path = os.path.join(DEM_EXPORT_FOLDER, "batch_stats_" + timestamp + ".csv")
+results.sort(key=lambda result: result["job"])
+writeSummary(results, summary_path)
+mergeStats(results, stats_path)
+
+print("""
+######################################
+Finished batch: {finished} of {count} jobs successful
+The batch took: {duration}
+Summary: {summary}
+Stats of all chunks: {stats}
+######################################
+""".format(finished=sum(result["status"] == "finished" for result in results), count=len(results),
+	duration=datetime.now() - start_time, summary=summary_path, stats=stats_path))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the GcpDetector on synthetic images, runs without Metashape
+
+Measures throughput (images/sec), time per detection stage, detection rate and pixel error
+for different image sizes and detector settings.
+
+Usage (from the repository root):
+    python -m gcp_detector.benchmark --sizes 2000x1500,4000x3000 --count 10 --save bench.json
+    python -m gcp_detector.benchmark --compare bench.json    # compare with an earlier run
+    python -m gcp_detector.benchmark --configs "pyramid=2;pyramid=4" --compare bench.json --compare-config pyramid=1
+"""
+
+import io
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+import numpy as np
+
+from gcp_detector.gcpDetector import GcpDetector
+from gcp_detector.syntheticGcp import generateDataset
+
+
+def parseConfigs(text):
+    # "pyramid=1,max_gcps=1;pyramid=4" -> [{"pyramid": 1, "max_gcps": 1}, {"pyramid": 4}]
+    configs = []
+    for part in text.split(";"):
+        params = {}
+        for item in part.split(","):
+            if item.strip() == "": continue
+            key, value = item.split("=")
+            params[key.strip()] = int(value)
+        configs.append(params)
+    return configs
+
+
+def configName(params):
+    return ",".join("{}={}".format(k, v) for k, v in sorted(params.items())) or "default"
+
+
+def matchDetections(detections, truths, tolerance):
+    # Greedy assignment of detections to the nearest true target
+    # target_errors has the error of every target in the order of truths, None for a missed target
+    target_errors = [None] * len(truths)
+    unmatched = list(range(len(truths)))
+    false_positives = 0
+    for detection in detections:
+        if len(unmatched) > 0:
+            distances = [math.dist(detection, truths[t]) for t in unmatched]
+            best = int(np.argmin(distances))
+            if distances[best] <= tolerance:
+                target_errors[unmatched.pop(best)] = distances[best]
+                continue
+        false_positives += 1
+    return [e for e in target_errors if e is not None], false_positives, target_errors
+
+
+def runBenchmark(dataset, params, tolerance = 5):
+    detector = GcpDetector(**params)
+
+    errors = []
+    target_errors = []
+    false_positives = 0
+    targets = 0
+    start = time.perf_counter()
+    for path, truths in dataset:
+        # The detector prints debug output, keep the benchmark output readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            detections = detector.detectGcps(path)
+        image_errors, image_fp, image_target_errors = matchDetections(detections, truths, tolerance)
+        errors += image_errors
+        target_errors += image_target_errors
+        false_positives += image_fp
+        targets += len(truths)
+    duration = time.perf_counter() - start
+
+    # Stage times measured by the detector itself
+    timings = detector.timer.pop()
+    count = len(dataset)
+    return {
+        "images": count,
+        "images_per_sec": count / duration if duration > 0 else 0,
+        "stage_ms": {stage: 1000 * sum(t) / count for stage, t in timings["samples"].items()},
+        "counters": timings["counters"],
+        "detection_rate": len(errors) / targets if targets > 0 else 0,
+        "false_positives": false_positives,
+        "error_mean_px": float(np.mean(errors)) if errors else None,
+        "error_p95_px": float(np.percentile(errors, 95)) if errors else None,
+        "target_errors_px": target_errors,
+    }
+
+
+def printResults(results):
+    for key, r in results.items():
+        print("{}".format(key))
+        print("    {:.2f} images/sec   detection rate {:.0%}   false positives {}   error mean {} px   p95 {} px".format(
+            r["images_per_sec"], r["detection_rate"], r["false_positives"],
+            "-" if r["error_mean_px"] is None else "{:.2f}".format(r["error_mean_px"]),
+            "-" if r["error_p95_px"] is None else "{:.2f}".format(r["error_p95_px"])))
+        print("    ms/image: " + "  ".join("{} {:.1f}".format(s, t) for s, t in r["stage_ms"].items()))
+        print("    counters: " + "  ".join("{} {}".format(c, n) for c, n in r.get("counters", {}).items()))
+
+
+def printComparison(results, baseline, baseline_config = None):
+    print("\nComparison with baseline:")
+    for key, r in results.items():
+        base_key = key
+        if baseline_config is not None:
+            # Compare with another detector config of the same size, e.g. the pyramid modes with the full resolution
+            base_key = "{} [{}]".format(key.split(" [")[0], configName(parseConfigs(baseline_config)[0]))
+        if base_key not in baseline:
+            print("{}: not in baseline".format(base_key))
+            continue
+        b = baseline[base_key]
+        speedup = r["images_per_sec"] / b["images_per_sec"] if b["images_per_sec"] else float("nan")
+        print("{}".format(key) if base_key == key else "{} vs {}".format(key, base_key))
+        print("    speed x{:.2f} ({:.2f} -> {:.2f} images/sec)   detection rate {:+.0%}   false positives {:+d}".format(
+            speedup, b["images_per_sec"], r["images_per_sec"],
+            r["detection_rate"] - b["detection_rate"], r["false_positives"] - b["false_positives"]))
+        if r["error_mean_px"] is not None and b["error_mean_px"] is not None:
+            print("    error mean {:+.2f} px   p95 {:+.2f} px".format(
+                r["error_mean_px"] - b["error_mean_px"], r["error_p95_px"] - b["error_p95_px"]))
+        if len(r.get("target_errors_px", [])) == len(b.get("target_errors_px", [])) > 0:
+            # Target by target, only valid if both runs used the same images (sizes, count, seed, targets)
+            pairs = list(zip(b["target_errors_px"], r["target_errors_px"]))
+            missed = sum(1 for e_b, e_r in pairs if e_b is not None and e_r is None)
+            added = sum(1 for e_b, e_r in pairs if e_b is None and e_r is not None)
+            changes = [e_r - e_b for e_b, e_r in pairs if e_b is not None and e_r is not None]
+            print("    targets: {} missed   {} added   {} of {} with the same error   largest error increase {:+.2f} px".format(
+                missed, added, sum(1 for c in changes if abs(c) < 0.005), len(changes), max(changes, default=0)))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="GcpDetector benchmark on synthetic images")
+    parser.add_argument('--sizes', default="2000x1500,4000x3000", help='Image sizes WIDTHxHEIGHT, comma separated')
+    parser.add_argument('--count', type=int, default=10, help='Images per size')
+    parser.add_argument('--targets', type=int, default=1, help='GCPs per image')
+    parser.add_argument('--configs', default="pyramid=1;pyramid=4", help='Detector parameter sets, separated by ";"')
+    parser.add_argument('--tolerance', type=float, default=5, help='Maximum distance in pixels of a correct detection')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='Compare results with a JSON file of an earlier run')
+    parser.add_argument('--compare-config', help='Compare every config with this config of the --compare file, e.g. pyramid=1')
+    args = parser.parse_args(argv)
+
+    results = {}
+    folder = tempfile.mkdtemp(prefix="gcp_benchmark_")
+    try:
+        for size in args.sizes.split(","):
+            width, height = [int(v) for v in size.lower().split("x")]
+            print("Rendering {} images {}x{}...".format(args.count, width, height))
+            dataset = generateDataset(folder, args.count, width, height, seed = args.seed, targets = args.targets)
+            for params in parseConfigs(args.configs):
+                key = "{}x{} [{}]".format(width, height, configName(params))
+                results[key] = runBenchmark(dataset, params, args.tolerance)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    printResults(results)
+
+    if args.compare:
+        with open(args.compare, encoding="utf8") as f:
+            printComparison(results, json.load(f)["results"], args.compare_config)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=4)
+        print("Results saved to {}".format(args.save))
+
+
+if __name__ == "__main__":
+    main()
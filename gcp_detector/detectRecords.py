@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Headless GCP detection, runs without Metashape on all cores
+
+Detects the GCPs on all images of a records directory (same layout as 1_autoDEM.py imports:
+YYYY-MM-DD_[Field]/FPLAN/*.JPG) and writes the pixel positions to a detection file.
+1_autoDEM.py pins the markers from this file instead of detecting them again:
+    1_autoDEM.py ... --detections gcp_detections.csv
+
+Usage (from the repository root):
+    python -m gcp_detector.detectRecords /data/records --year 2023 --field R1 --out gcp_detections.csv
+"""
+
+import os
+import sys
+import time
+import argparse
+import configparser
+from concurrent.futures import ProcessPoolExecutor
+
+from metashape_util.file_utils import FileUtils
+from gcp_detector.gcpDetector import GcpDetector, initDetectionWorker, detectGcp
+from gcp_detector.detectionFile import writeDetections
+
+
+def findImages(records_path, year = None, field = None):
+    # All images of the records matching year and field (None matches all)
+    images = []
+    for record_year, fields in sorted(FileUtils.scanRecordsDir(records_path).items()):
+        if year and record_year != year: continue
+        for record_field, dates in sorted(fields.items()):
+            if field and record_field != field: continue
+            for date, record_path in sorted(dates.items()):
+                images += sorted(FileUtils.getRecordPhotos(record_path))
+    return images
+
+
+def detectorParams(args):
+    # Detector settings from section [GcpDetection] of config.ini, overridden by the command line
+    params = {}
+    config = configparser.ConfigParser()
+    if config.read(args.config) and config.has_section("GcpDetection"):
+        section = config["GcpDetection"]
+        params = {
+            "pyramid": section.getint("GCP_PYRAMID_SCALE", 1),
+            "max_gcps": section.getint("GCP_MAX_PER_IMAGE", 1),
+        }
+    if args.pyramid is not None:
+        params["pyramid"] = args.pyramid
+    if args.max_gcps is not None:
+        params["max_gcps"] = args.max_gcps
+    return params
+
+
+def detectImages(images, params, workers):
+    # Yields (image, centers) in the order of images
+    with ProcessPoolExecutor(max_workers=workers, initializer=initDetectionWorker, initargs=(params,)) as pool:
+        for image, (centers, timings) in zip(images, pool.map(detectGcp, images, chunksize=4)):
+            yield image, centers
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Detect GCPs in a records directory without Metashape")
+    parser.add_argument('records_path', help='Directory to scan for records')
+    parser.add_argument('--year', help='Only records of this year')
+    parser.add_argument('--field', help='Only records of this field, must match folder name')
+    parser.add_argument('--out', help='Detection file to write, default: gcp_detections.csv in records_path')
+    parser.add_argument('--workers', type=int, default=0, help='Worker processes, 0 = one per cpu core')
+    parser.add_argument('--config', default=os.path.join(sys.path[0], "config.ini"), help='config.ini with section [GcpDetection]')
+    parser.add_argument('--pyramid', type=int, help='Overrides GCP_PYRAMID_SCALE')
+    parser.add_argument('--max-gcps', dest='max_gcps', type=int, help='Overrides GCP_MAX_PER_IMAGE')
+    args = parser.parse_args(argv)
+
+    images = findImages(args.records_path, args.year, args.field)
+    if len(images) == 0:
+        print("No images found in " + args.records_path)
+        return 1
+
+    out = args.out or os.path.join(args.records_path, "gcp_detections.csv")
+    params = GcpDetector(**detectorParams(args)).getParams()
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    print("Detecting GCPs in {} images with {} workers, parameters: {}".format(len(images), workers, params))
+
+    start = time.time()
+    found = 0
+    def progress(detections):
+        nonlocal found
+        for i, (image, centers) in enumerate(detections):
+            found += len(centers) > 0
+            print("[{}/{}] {}: {}".format(i + 1, len(images), image, centers))
+            yield image, centers
+
+    writeDetections(out, progress(detectImages(images, params, workers)), params)
+    duration = time.time() - start
+    print("Finished, {} of {} images contain GCPs, {:.1f} images/sec".format(found, len(images), len(images) / duration))
+    print("Detections saved to " + out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
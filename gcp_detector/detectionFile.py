@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Exchange file of GCP detections made outside of Metashape (see detectRecords.py)
+
+CSV file, one row per found GCP and one row with empty coordinates for images without GCP:
+    image;size;x;y
+    2023-05-01_R1/FPLAN/IMG_001.JPG;8123456;2011.5;1490.0
+The first lines starting with "#" hold the detector parameters.
+Images are identified by record folder, mission folder and file name, so the file stays valid
+when the records are copied to another machine or drive.
+"""
+
+import os
+import csv
+import json
+
+HEADER = ["image", "size", "x", "y"]
+
+
+def imageKey(path):
+    # Last three path components (record/mission/file), independent of drive and path separator
+    parts = os.path.normpath(path).replace("\\", "/").split("/")
+    return "/".join(parts[-3:])
+
+
+def writeDetections(file, detections, params = None):
+    """
+    :param detections: iterable of (image path, centers) like GcpDetector.processImages() yields it
+    :param params: detector parameters, written to the file header
+    """
+    with open(file, "w", newline="", encoding="utf8") as f:
+        if params is not None:
+            f.write("# params: " + json.dumps(params, sort_keys=True) + "\n")
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(HEADER)
+        for path, centers in detections:
+            size = os.path.getsize(path)
+            if len(centers) == 0:
+                writer.writerow([imageKey(path), size, "", ""])
+            for x, y in centers:
+                writer.writerow([imageKey(path), size, "{:.2f}".format(x), "{:.2f}".format(y)])
+            f.flush()
+
+
+def readDetections(file):
+    """
+    :return: [detections, params] detections is a dict {lower case image key: (size, [(x, y), ...])}
+    """
+    detections = {}
+    params = None
+    with open(file, newline="", encoding="utf8") as f:
+        lines = []
+        for line in f:
+            if line.startswith("# params: "):
+                params = json.loads(line[len("# params: "):])
+            elif not line.startswith("#"):
+                lines.append(line)
+
+    for row in csv.DictReader(lines, delimiter=";"):
+        # Keys are compared case insensitive, like the paths on windows
+        size, centers = detections.setdefault(row["image"].lower(), (int(row["size"]), []))
+        if row["x"] != "" and row["y"] != "":
+            centers.append((float(row["x"]), float(row["y"])))
+    return detections, params
+
+
+def lookupDetections(detections, path):
+    """
+    Found GCPs of an image from the dict returned by readDetections()
+    :return: list of centers or None if the image is not in the file or its file size changed
+    """
+    entry = detections.get(imageKey(path).lower())
+    if entry is None:
+        return None
+    size, centers = entry
+    try:
+        if os.path.getsize(path) != size:
+            return None
+    except OSError:
+        return None
+    return list(centers)
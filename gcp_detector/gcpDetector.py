@@ -7,14 +7,55 @@
 """ Detect the pixel location of visible ground control points in given image"""
 
 import math
+import functools
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 
+from metashape_util.stage_timer import StageTimer
+
+
+# imread flags for the coarse search when decoding with reduced resolution
+# IMREAD_IGNORE_ORIENTATION keeps the pixel grid identical to the IMREAD_UNCHANGED full resolution decode
+REDUCED_READ_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2 | cv2.IMREAD_IGNORE_ORIENTATION,
+    4: cv2.IMREAD_REDUCED_COLOR_4 | cv2.IMREAD_IGNORE_ORIENTATION,
+    8: cv2.IMREAD_REDUCED_COLOR_8 | cv2.IMREAD_IGNORE_ORIENTATION,
+}
+
+# Half size of the full resolution window searched around a candidate in coarse-to-fine mode
+REFINE_WINDOW_SIZE = 64
+
+# Maximum number of moves of the crop towards the center of the blob, see _centerGuessPoint()
+CENTER_ITERATIONS = 10
+
+# Key points closer than this distance (full resolution pixels) belong to the same GCP candidate
+CLUSTER_RADIUS = 48
+
+# Increase when the detection algorithm changes, cached results of older versions are not used anymore
+DETECTOR_VERSION = 4
 
 class GcpDetector:
-    def __init__(self, image = False):
+    def __init__(self, image = False, pyramid = 1, max_gcps = 1, roi_size = 300):
             if(image != False):
                 self.image = image
+            # Coarse-to-fine mode: search candidates on an image decoded with 1/pyramid resolution
+            # 1 disables the coarse search and processes the full resolution image
+            if(pyramid not in REDUCED_READ_FLAGS):
+                pyramid = 1
+            self.pyramid = pyramid
+            # Maximum number of GCPs returned for one image, 1 only looks for the most likely GCP
+            self.max_gcps = max(1, max_gcps)
+            # Half size in pixels of the windows searched when the expected GCP positions are known
+            self.roi_size = roi_size
+            # Duration of the detection stages and counters, see StageTimer
+            self.timer = StageTimer()
+
+    def getParams(self):
+        """Returns the detector parameters, a detector created with these parameters gives identical results"""
+        return {"pyramid": self.pyramid, "max_gcps": self.max_gcps, "roi_size": self.roi_size, "version": DETECTOR_VERSION}
 
     def processImage(self, image = False):
         if(image == False):
@@ -22,12 +63,80 @@ class GcpDetector:
         if(image == False):
             raise Exception("No image specified")
 
+        # Returns the most likely GCP only, use detectGcps() to get all GCPs on the image
+        centers = self.detectGcps(image)
+        if(len(centers) <= 0):
+            return False
+        return centers[0]
+
+    def detectGcps(self, image, rois = None):
+        """
+        Returns a list with the pixel coordinates of all GCPs found on the image
+        :param rois: optional list of pixel coordinates (x, y) where GCPs are expected.
+                     Only the windows of +-roi_size pixels around these points are searched
+        """
+        buf, img = self._loadImage(image, rois)
+        return self._analyseImage(image, buf, img, rois)
+
+    def processImages(self, images, queue_depth = 4, threads = 2, rois = None):
+        """
+        Generator, processes all given images and yields (image, centers) for every image in the given order
+        centers is the list of found GCPs like detectGcps() returns it
+        rois is an optional dict {image: [(x, y), ...]} with the expected GCP positions of the images
+        Upcoming files are read and decoded on background threads while the current image is analysed.
+        Not more than queue_depth decoded images are held in memory (the analysed one included), in
+        coarse-to-fine mode each of them also holds its raw file for the full resolution decode.
+        """
+        images = iter(images)
+        rois = rois or {}
+        pending = deque()
+        pool = ThreadPoolExecutor(max_workers=max(1, threads))
+        try:
+            for image in itertools.islice(images, max(1, queue_depth)):
+                pending.append((image, pool.submit(self._loadImage, image, rois.get(image))))
+
+            while pending:
+                image, future = pending.popleft()
+                buf, img = future.result()
+                centers = self._analyseImage(image, buf, img, rois.get(image))
+                del buf, img
+
+                # Refill the queue after the analysis, the images still pending are loaded while the current one is analysed
+                for next_image in itertools.islice(images, 1):
+                    pending.append((next_image, pool.submit(self._loadImage, next_image, rois.get(next_image))))
+
+                yield image, centers
+        finally:
+            # The generator may be closed early, do not read the remaining files
+            for image, future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+
+    def _loadImage(self, image, rois = None):
         # First read the image file in a cv2 frame
         # cv2.imread(image) trows error with space in path this version is more stable
-        img = cv2.imdecode(np.fromfile(image, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        with self.timer.stage("read"):
+            buf = np.fromfile(image, dtype=np.uint8)
+        with self.timer.stage("decode"):
+            if(self.pyramid > 1 and rois is None):
+                # Coarse search: let the jpeg decoder scale down the image, this is much faster than a full decode
+                # the raw file is kept for the full resolution decode of the candidate window
+                img = cv2.imdecode(buf, REDUCED_READ_FLAGS[self.pyramid])
+            else:
+                img = cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+                buf = None
+        return buf, img
+
+    def _analyseImage(self, image, buf, img, rois = None):
+        """Returns a list with the pixel coordinates of the found GCPs, the most likely GCP first"""
         if np.shape(img) == ():
             print("Image could not be read: {}".format(image))
-            return False
+            return []
+        self.timer.count("images")
+
+        if(rois is not None):
+            # Guided mode: the expected GCP positions are known, only the windows around them are searched
+            return self._searchWindows(img, rois, self.roi_size, 16)
 
         # Filter image by saturation - this removes all saturated pixels and leaves only gray pixels
         img_sat = self._filterPixelsBySaturation(img)
@@ -37,17 +146,55 @@ class GcpDetector:
 
         # Find key points in image
         # If there is a GCP on this image many key points are on or around the GCP
-        pts = self._findKeyPoints(img_gray)
-        if(len(pts) <= 0): return False
-        
-        # The guess point is the point with the smallest distance to every other point
-        guess_point = self._getBestMatchingKeyPoint(pts)
-        if(guess_point == False): return False
+        pts = self._findKeyPoints(img_gray, nfeatures = 6 * self.max_gcps)
+        if(len(pts) <= 0): return []
 
-        print(guess_point)
+        if(self.max_gcps > 1):
+            # Every cluster of key points is a possible GCP
+            guess_points = self._getClusterGuessPoints(pts, CLUSTER_RADIUS / self.pyramid)
+        else:
+            # The guess point is the point with the smallest distance to every other point
+            guess_point = self._getBestMatchingKeyPoint(pts)
+            guess_points = [guess_point] if guess_point != False else []
+        if(len(guess_points) <= 0): return []
+        self.timer.count("candidates", len(guess_points))
 
         # Now look at area around the guess point and try to locate the center of the GCP
         crop_size = 16
+        if(self.pyramid > 1):
+            # The shape check needs white pixels around the center, candidates without any in their
+            # coarse window can not be a GCP. Only images with a remaining candidate are decoded in full resolution
+            radius = REFINE_WINDOW_SIZE // self.pyramid + 1
+            guess_points = [point for point in guess_points if self._hasWhitePixels(img_gray, point, radius)]
+            # Free the coarse images before the full resolution decode to keep the peak memory low
+            del img, img_sat, img_gray
+            if(len(guess_points) <= 0):
+                self.timer.count("refine_skipped")
+                return []
+            return self._refineOnFullResolution(buf, guess_points, crop_size)
+
+        if(self.max_gcps <= 1):
+            center = self._locateGcp(img_gray, guess_points[0], crop_size)
+            # Counts the found GCP like in the other modes
+            return self._mergeCenters([center] if center != False else [], crop_size)
+
+        # Multiple candidates: calculate all centers first, then check the shapes of all candidates in one pass
+        centers = []
+        for guess_point in guess_points:
+            guess_point = self._centerGuessPoint(img_gray, guess_point, crop_size)
+            if(guess_point == False): continue
+            crop = self._cropImageAroundPoint(img_gray, guess_point, crop_size)
+            gcpCenter = self._findCenterOfObject(crop)
+            if(gcpCenter == False): continue
+            centers.append((guess_point[0] - crop_size + gcpCenter[0], guess_point[1] - crop_size + gcpCenter[1]))
+        if(len(centers) <= 0): return []
+
+        isGCP = self._checkGcpShapes(centers, img_gray)[:, 0]
+        return self._mergeCenters([c for c, ok in zip(centers, isGCP) if ok], crop_size)
+
+    def _locateGcp(self, img_gray, guess_point, crop_size):
+        guess_point = self._centerGuessPoint(img_gray, guess_point, crop_size)
+        if(guess_point == False): return False
         crop = self._cropImageAroundPoint(img_gray, guess_point, crop_size)
 
         # this utilises cv2.moments() function to find the center of the blob of white pixels
@@ -65,37 +212,122 @@ class GcpDetector:
         centerX = guess_point[0] - crop_size + gcpCenter[0]
         centerY = guess_point[1] - crop_size + gcpCenter[1]
         return centerX, centerY
-        
+
+    def _centerGuessPoint(self, img_gray, guess_point, crop_size):
+        """
+        Moves the guess point to the center of the blob in the crop around it until the crop does not move anymore
+        The center of the blob depends on the position of the crop, a centered crop gives the same center
+        for every guess point near the GCP (e.g. key points of the full or of the reduced image)
+        :return: the centered guess point or False if the crop contains no blob
+        """
+        guess_point = [int(guess_point[0]), int(guess_point[1])]
+        for i in range(CENTER_ITERATIONS):
+            gcpCenter = self._findCenterOfObject(self._cropImageAroundPoint(img_gray, guess_point, crop_size))
+            if(gcpCenter == False): return False
+            next_point = [int(round(guess_point[0] - crop_size + gcpCenter[0])), int(round(guess_point[1] - crop_size + gcpCenter[1]))]
+            if(next_point == guess_point): break
+            guess_point = next_point
+        return guess_point
+
+    def _refineOnFullResolution(self, buf, coarse_points, crop_size):
+        # OpenCV can not decode a part of the JPEG, the whole image is decoded a second time in full resolution
+        with self.timer.stage("decode_full"):
+            img = cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+        if np.shape(img) == ():
+            return []
+
+        # Map the guess points of the reduced image to full resolution (center of the reduced pixel)
+        # only windows around these points are processed in full resolution
+        points = [[int((c + 0.5) * self.pyramid - 0.5) for c in coarse_point] for coarse_point in coarse_points]
+        # _locateGcp() centers the crop on the GCP, so the mapped points give the same center as the
+        # key points of the full resolution search and the key points are not searched again
+        return self._searchWindows(img, points, REFINE_WINDOW_SIZE + self.pyramid, crop_size, keypoints = False)
+
+    def _searchWindows(self, img, points, radius, crop_size, keypoints = True):
+        """
+        Searches one GCP in a window of +-radius pixels around each point of the full resolution image
+        :param keypoints: search the key points of the window first, for points which are only accurate to several pixels
+        """
+        centers = []
+        h, w = img.shape[:2]
+        for cX, cY in points:
+            cX, cY = int(cX), int(cY)
+            xMin, xMax = self._clamp(cX - radius, 0, w), self._clamp(cX + radius, 0, w)
+            yMin, yMax = self._clamp(cY - radius, 0, h), self._clamp(cY + radius, 0, h)
+            if(xMax - xMin <= 2 * crop_size or yMax - yMin <= 2 * crop_size): continue
+            window = img[yMin:yMax, xMin:xMax]
+            self.timer.count("windows")
+
+            # Filtering only the window gives the same pixels as filtering the full image
+            window_gray = cv2.cvtColor(self._filterPixelsBySaturation(window), cv2.COLOR_BGR2GRAY)
+
+            # The given point may be far from the GCP, search the key points of the window like the full image search
+            # If this guess does not verify, the single key points and the given point are tried as well
+            guess_points = []
+            pts = self._findKeyPoints(window_gray) if keypoints else []
+            if(len(pts) > 0):
+                guess_points.append(self._getBestMatchingKeyPoint(pts))
+                guess_points += [[int(x), int(y)] for x, y in pts]
+            guess_points.append([cX - xMin, cY - yMin])
+
+            for guess_point in guess_points:
+                if(guess_point == False): continue
+                center = self._locateGcp(window_gray, guess_point, crop_size)
+                if(center != False):
+                    # Coordinates in the real image instead of the window
+                    centers.append((xMin + center[0], yMin + center[1]))
+                    break
+        del img
+
+        return self._mergeCenters(centers, crop_size)
+
+    def _hasWhitePixels(self, img_gray, point, radius):
+        # True if the window of +-radius pixels around the point contains a pixel the shape check counts as white
+        xMin, xMax = self._clamp(int(point[0]) - radius, 0, img_gray.shape[1]), self._clamp(int(point[0]) + radius + 1, 0, img_gray.shape[1])
+        yMin, yMax = self._clamp(int(point[1]) - radius, 0, img_gray.shape[0]), self._clamp(int(point[1]) + radius + 1, 0, img_gray.shape[0])
+        window = img_gray[yMin:yMax, xMin:xMax]
+        return window.size > 0 and window.max() > SHAPE_WHITE_THRESHOLD
+
+    def _mergeCenters(self, centers, min_distance):
+        # Candidates closer than min_distance found the same GCP, keep the first (most likely) one
+        merged = []
+        for center in centers:
+            if all(math.dist(center, m) >= min_distance for m in merged):
+                merged.append(center)
+        self.timer.count("gcps", min(len(merged), self.max_gcps))
+        return merged[:self.max_gcps]
 
     def _filterPixelsBySaturation(self, img):
-        # Preparing the mask to overlay
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        mask = cv2.inRange(hsv, np.array([0, 0, 100]), np.array([255, 50, 255]))
-        # The black region in the mask has the value of 0,
-        # So when multiplied with original image removes all non-gray regions
-        return cv2.bitwise_and(img, img, mask = mask)
-
-    def _findKeyPoints(self, img):
-        # Create ORB keypoint detector
-        orb = cv2.ORB_create(
-            edgeThreshold=15, 
-            patchSize=31, 
-            nlevels=8, 
-            fastThreshold=20, 
-            scaleFactor=12/10, 
-            WTA_K=2,
-            scoreType=cv2.ORB_HARRIS_SCORE, 
-            firstLevel=0, 
-            nfeatures=6 )
-
-        # Find the keypoints with ORB
-        kp = orb.detect(img,None)
-
-        # Compute the descriptors with ORB
-        kp, des = orb.compute(img, kp)
-
-        pts = cv2.KeyPoint_convert(kp)
-        return pts
+        with self.timer.stage("saturation"):
+            # Preparing the mask to overlay
+            hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+            mask = cv2.inRange(hsv, np.array([0, 0, 100]), np.array([255, 50, 255]))
+            # The black region in the mask has the value of 0,
+            # So when multiplied with original image removes all non-gray regions
+            return cv2.bitwise_and(img, img, mask = mask)
+
+    def _findKeyPoints(self, img, nfeatures = 6):
+        with self.timer.stage("keypoints"):
+            # Create ORB keypoint detector
+            orb = cv2.ORB_create(
+                edgeThreshold=15, 
+                patchSize=31, 
+                nlevels=8, 
+                fastThreshold=20, 
+                scaleFactor=12/10, 
+                WTA_K=2,
+                scoreType=cv2.ORB_HARRIS_SCORE, 
+                firstLevel=0, 
+                nfeatures=nfeatures )
+
+            # Find the keypoints with ORB
+            kp = orb.detect(img,None)
+
+            # Compute the descriptors with ORB
+            kp, des = orb.compute(img, kp)
+
+            pts = cv2.KeyPoint_convert(kp)
+            return pts
 
     def _getBestMatchingKeyPoint(self, pts):
         weighted_points = self._getWeightedPointsByDistance(pts)
@@ -111,6 +343,34 @@ class GcpDetector:
         avg_point = self._avgPoint(best_weighted_points)
         return avg_point
 
+    def _getClusterGuessPoints(self, pts, radius):
+        """
+        Groups the key points in clusters of points closer than radius, every cluster is a possible GCP
+        :return: guess point of every cluster with at least 2 points, clusters with most points first
+        """
+        pts = np.asarray(pts, dtype=float)
+        dist = np.linalg.norm(pts[:, np.newaxis, :] - pts[np.newaxis, :, :], axis=-1)
+
+        # Connected components: every point takes the smallest label of its neighbours until nothing changes
+        near = dist < radius
+        labels = np.arange(len(pts))
+        while True:
+            new_labels = np.where(near, labels[np.newaxis, :], len(pts)).min(axis=1)
+            if np.array_equal(new_labels, labels): break
+            labels = new_labels
+
+        clusters = []
+        for label in np.unique(labels):
+            members = np.flatnonzero(labels == label)
+            if(len(members) < 2): continue
+            # Like in single mode the guess is the average of the 2 points with the smallest distance to the others
+            weights = dist[np.ix_(members, members)].sum(axis=1)
+            best = members[np.argsort(weights, kind="stable")[:2]]
+            clusters.append((len(members), weights.min(), self._avgPoint(pts[best])))
+
+        clusters.sort(key=lambda c: (-c[0], c[1]))
+        return [c[2] for c in clusters]
+
     def _getWeightedPointsByDistance(self, pts):
         z = np.array([complex(p[0], p[1]) for p in pts])
         out = abs(z[..., np.newaxis] - z) # calculate distances to other points
@@ -137,62 +397,95 @@ class GcpDetector:
         return num
 
     def _findCenterOfObject(self, img):
-        # calculate moments of binary image
-        M = cv2.moments(img)
-        # calculate x,y coordinate of center (coordinates are of cropped image)
-        if(M["m00"] == 0): return False
-        cX = M["m10"] / M["m00"]
-        cY = M["m01"] / M["m00"]
-        return [cX, cY]
-
-    def _checkGcpShape(self, center, img):
-        # First threshold image to get binary image (and detect the white spots)
-        thresh, img = cv2.threshold(img, 150, 255, cv2.THRESH_BINARY)
-
-        #check if surroundings match a hourglass or chess field shape
-        gcp_matched = False
-        r = 5 # check pixels with a radius of 5
-        # if basic shape is matched check also 
-        min_degrees = 30
-        min_radians = min_degrees * math.pi / 180
-
-        # loop from -3.14 to +3.14 (to get all points circular around the center)
-        match_start = False
-        for a in np.arange(- math.pi, math.pi, 0.1):
-            gcp_matched = self._crossDetect(img, center, a, r)
-            if(gcp_matched == True and match_start == False):
-                match_start = a
-            if(gcp_matched == False and match_start != False):
-                #end of match
-                if(abs(match_start - a) > min_radians):
-                    gcp_matched = True
-                else:
-                    gcp_matched = False
-                break
-
-        return gcp_matched
-
-    def _crossDetect(self, img, center, angle = 0, r = 5):
-        cX, cY = center
-
-        checkX = round(cX + math.sin(angle) * r)
-        checkY = round(cY + math.cos(angle) * r)
-        try:
-            # for each point check if the pixel is black
-            if(all(img[checkY, checkX] == (0,0,0))):
-                # if pixel is black check if opposite point is also black
-                oppX = round(cX + math.sin(angle + math.pi) * r)
-                oppY = round(cY + math.cos(angle + math.pi) * r)
-                if(all(img[oppY, oppX] == (0,0,0))):
-                    # when check and opposide points are both black,
-                    # the left and right points on the circle must be white (in case of an GCP)
-                    leftX = round(cX + math.sin(angle + math.pi*0.5) * r)
-                    leftY = round(cY + math.cos(angle + math.pi*0.5) * r)
-
-                    rightX = round(cX + math.sin(angle + math.pi*1.5) * r)
-                    rightY = round(cY + math.cos(angle + math.pi*1.5) * r)
-                    if(all(img[leftY, leftX] != (0,0,0)) and all(img[rightY, rightX] != (0,0,0))):
-                        return True
-            return False
-        except IndexError:
-            return False
\ No newline at end of file
+        with self.timer.stage("center"):
+            # calculate moments of binary image
+            M = cv2.moments(img)
+            # calculate x,y coordinate of center (coordinates are of cropped image)
+            if(M["m00"] == 0): return False
+            cX = M["m10"] / M["m00"]
+            cY = M["m01"] / M["m00"]
+            return [cX, cY]
+
+    def _checkGcpShape(self, center, img, r = 5):
+        # check pixels with a radius of 5
+        return bool(self._checkGcpShapes([center], img, (r,))[0, 0])
+
+    def _checkGcpShapes(self, centers, img, radii = (5,)):
+        """
+        Checks if the surroundings of the given centers match a hourglass or chess field shape
+        All centers and radii are checked in one pass
+        :return: boolean array with shape (len(centers), len(radii))
+        """
+        with self.timer.stage("shape"):
+            # First threshold image to get binary image (and detect the white spots)
+            thresh, img = cv2.threshold(img, SHAPE_WHITE_THRESHOLD, 255, cv2.THRESH_BINARY)
+
+            centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+            offsets = _ringOffsets(tuple(radii)) # (radii, 4, angles, 2)
+
+            # Pixel coordinates of all ring samples: (centers, radii, 4, angles)
+            x = np.round(centers[:, 0, None, None, None] + offsets[np.newaxis, ..., 0]).astype(int)
+            y = np.round(centers[:, 1, None, None, None] + offsets[np.newaxis, ..., 1]).astype(int)
+
+            # Samples outside the image never match (negative indices wrap around like plain numpy indexing)
+            h, w = img.shape[:2]
+            valid = (x >= -w) & (x < w) & (y >= -h) & (y < h)
+            pixels = img[np.where(valid, y, 0), np.where(valid, x, 0)]
+            if pixels.ndim > valid.ndim: # color image, compare all channels
+                black = np.all(pixels == 0, axis=-1) & valid
+                white = np.all(pixels != 0, axis=-1) & valid
+            else:
+                black = (pixels == 0) & valid
+                white = (pixels != 0) & valid
+
+            # When check and opposite points are both black,
+            # the left and right points on the circle must be white (in case of an GCP)
+            matches = black[:, :, 0] & black[:, :, 1] & white[:, :, 2] & white[:, :, 3] # (centers, radii, angles)
+
+            # Look at the first continuous range of matching angles
+            # if it is wider than the minimum angle (or does not end) the shape is a GCP
+            index = np.arange(len(SHAPE_ANGLES))
+            any_match = matches.any(axis=-1)
+            match_start = np.argmax(matches, axis=-1)
+            match_end_mask = ~matches & (index > match_start[..., np.newaxis])
+            has_end = match_end_mask.any(axis=-1)
+            match_end = np.argmax(match_end_mask, axis=-1)
+
+            wide_enough = np.abs(SHAPE_ANGLES[match_start] - SHAPE_ANGLES[match_end]) > SHAPE_MIN_RADIANS
+            return any_match & (~has_end | wide_enough)
+
+
+# Gray values above this threshold are white in the shape check
+SHAPE_WHITE_THRESHOLD = 150
+# Angles checked around a GCP center (from -3.14 to +3.14 to get all points circular around the center)
+SHAPE_ANGLES = np.arange(- math.pi, math.pi, 0.1)
+# if basic shape is matched the matching angles must cover at least this range
+SHAPE_MIN_RADIANS = 30 * math.pi / 180
+
+@functools.lru_cache(maxsize=16)
+def _ringOffsets(radii):
+    # Offsets (x, y) of the sample points on the ring around a center, computed once per set of radii
+    # For every angle four points are sampled: the check point, the opposite point, left and right
+    angles = SHAPE_ANGLES[np.newaxis, :] + np.array([0, math.pi, math.pi*0.5, math.pi*1.5])[:, np.newaxis]
+    r = np.asarray(radii, dtype=float)[:, np.newaxis, np.newaxis]
+    return np.stack([np.sin(angles) * r, np.cos(angles) * r], axis=-1)
+
+
+# Worker side of the parallel detection (see GcpToMarker)
+# These functions run inside the pool workers, so this module must stay importable without Metashape
+_worker_detector = None
+
+def initDetectionWorker(params = {}):
+    # params as returned by getParams(), the version is not a constructor argument
+    global _worker_detector
+    _worker_detector = GcpDetector(**{key: value for key, value in params.items() if key != "version"})
+
+def detectGcp(image, rois = None):
+    """
+    Pool entry point: runs the detector of the current worker on a single image path
+    :return: [centers, timings] timings are the stage times of this image (see StageTimer.pop())
+    """
+    if _worker_detector is None:
+        initDetectionWorker()
+    centers = _worker_detector.detectGcps(image, rois)
+    return centers, _worker_detector.timer.pop()
\ No newline at end of file
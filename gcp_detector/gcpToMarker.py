@@ -1,22 +1,90 @@
 import Metashape
+import os, sys
+import itertools
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pprint import pprint
-from gcp_detector.gcpDetector import GcpDetector
+import numpy as np
+from metashape_util.chunk import ChunkUtils
+from gcp_detector.gcpDetector import GcpDetector, initDetectionWorker, detectGcp
+from gcp_detector.detectionFile import readDetections, lookupDetections
+from metashape_util.stage_timer import StageTimer
+from metashape_util.file_cache import FileCache
 
 app = Metashape.Application()
 doc = app.document
 
-gcpDetect = GcpDetector()
-
 class GcpToMarker:
-    def _init_(self, chunk = False):
+    # Maximum horizontal distance (in units of the chunk crs) between a detected GCP and the marker reference
+    MARKER_MAX_DISTANCE = 0.0003
+
+    def __init__(self, chunk = False, config = None, cache_path = False):
         self.chunk = chunk
 
-    def processChunk(self, chunk = False):
+        # Parallel detection settings, see section [GcpDetection] in config.ini
+        # 0 = one worker per cpu core, 1 = detect in the main thread
+        self.WORKERS = 1
+        self.POOL = "process"
+        pyramid = 1
+        max_gcps = 1
+        self.PREFETCH_DEPTH = 4
+        self.PREFILTER = True
+        self.PREFILTER_MARGIN = 1.2
+        self.GUIDED = True
+        roi_size = 300
+        self.UNPIN_MAX_ERROR = 283
+        self.UNPIN_MAD_FACTOR = 3.0
+        self.UNPIN_MIN_ERROR = 5
+        if(config is not None):
+            self.WORKERS = config.getint("GCP_DETECTION_WORKERS", 1)
+            self.POOL = config.get("GCP_DETECTION_POOL", "process").strip().lower()
+            pyramid = config.getint("GCP_PYRAMID_SCALE", 1)
+            self.PREFETCH_DEPTH = config.getint("GCP_PREFETCH_DEPTH", 4)
+            max_gcps = config.getint("GCP_MAX_PER_IMAGE", 1)
+            self.PREFILTER = config.getboolean("GCP_PREFILTER", True)
+            self.PREFILTER_MARGIN = config.getfloat("GCP_PREFILTER_MARGIN", 1.2)
+            self.GUIDED = config.getboolean("GCP_GUIDED_SEARCH", True)
+            roi_size = config.getint("GCP_ROI_SIZE", 300)
+            self.UNPIN_MAX_ERROR = config.getfloat("GCP_UNPIN_MAX_ERROR", 283)
+            self.UNPIN_MAD_FACTOR = config.getfloat("GCP_UNPIN_MAD_FACTOR", 3.0)
+            self.UNPIN_MIN_ERROR = config.getfloat("GCP_UNPIN_MIN_ERROR", 5)
+        if(self.WORKERS <= 0):
+            self.WORKERS = os.cpu_count() or 1
+
+        self.detector = GcpDetector(pyramid = pyramid, max_gcps = max_gcps, roi_size = roi_size)
+
+        # Detection results are cached on disk, reruns only process new or modified images
+        self.cache = None
+        if(cache_path and (config is None or config.getboolean("GCP_DETECTION_CACHE", True))):
+            self.cache = FileCache(cache_path, self.detector.getParams(), table = "detections")
+
+        # Detections imported from a file of the headless detection (see detectRecords.py and importDetections())
+        self.importedDetections = {}
+
+        # Metrics of the last processed chunk, see processChunk()
+        # The stage times of the detector are merged into this timer (also those of the pool workers)
+        self.timer = StageTimer()
+        self.chunkStats = {}
+
+    def processChunk(self, chunk = False, progress = None, cameras = None, items = None):
+        """
+        Detects the GCPs on the photos of the chunk and pins the markers
+        :param progress: progress callback like in the Metashape functions, percent of the searched photos
+        :param cameras: only search these cameras (e.g. photos appended to a processed chunk), default all cameras
+        :param items: callback receiving the number of searched photos, e.g. ProgressStatus.setItems
+        """
         if(chunk == False):
             chunk = self.chunk
         if(chunk == False):
             raise Exception("No Chunk specified.")
 
+        self.chunkStats = {}
+        self.timer.reset()
+        self.detector.timer.reset()
+        if(self.cache):
+            self.cache.resetCounters()
+
         # Setup shapes if not exist 
         # this is needed to draw the control points for visualisation on the map
         if not chunk.shapes:
@@ -24,86 +92,312 @@ class GcpToMarker:
             chunk.shapes.crs = chunk.crs
 
         # Next step is to loop through the cameras and try to detect a marker in every single image
-        for camera in chunk.cameras:
+        # The detection itself may run in parallel, pinning the markers always happens here in the main thread
+        cameras = [camera for camera in (cameras or chunk.cameras) if camera.photo]
+        if(self.PREFILTER):
+            # Only search images which can show a marker, based on the camera positions
+            selected = self._prefilterCameras(chunk, cameras)
+            self.chunkStats["prefilter_skipped"] = len(cameras) - len(selected)
+            cameras = selected
+        paths = [camera.photo.path for camera in cameras]
+        if(items is not None):
+            items(len(cameras))
+
+        # Aligned cameras: only search the windows around the projected marker positions
+        rois = {}
+        roi_markers = {}
+        if(self.GUIDED):
+            rois, roi_markers = self._predictGcpPixels(chunk, cameras)
+            self.chunkStats["guided_images"] = len(rois)
+
+        # Collect the detections of all images first, the markers are pinned in one batch afterwards
+        detections = [] # (camera, foundGCPs)
+        for index, (camera, foundGCPs) in enumerate(zip(cameras, self._detectImages(paths, rois, roi_markers))):
             print("Processing " + camera.photo.path + "...")
-            self._processCamera(chunk, camera)
+            if(progress is not None):
+                progress(100 * (index + 1) / len(cameras))
+            if(len(foundGCPs) > 0):
+                detections.append((camera, foundGCPs))
+        self._pinDetections(chunk, detections)
+
+        with self.timer.stage("app_update"):
+            app.update()
+
+        if(self.cache):
+            self.chunkStats["cache_hits"] = self.cache.hits
+            self.chunkStats["cache_misses"] = self.cache.misses
 
         # Cleanup
         # Bad markers are outliers, for example points that are only detected in a single image
-        self._unpinBadMarkers(chunk)
+        with self.timer.stage("unpin"):
+            self._unpinBadMarkers(chunk)
 
         # Update Model
-        chunk.updateTransform()
+        with self.timer.stage("update_transform"):
+            chunk.updateTransform()
 
         # Optimize Cameras
-        chunk.optimizeCameras()
+        with self.timer.stage("optimize"):
+            chunk.optimizeCameras()
+
+        self.chunkStats.update(self.timer.summary())
 
         
-    def _processCamera(self, chunk, camera):
-        # Process image and try to detect GCP
-        foundGCP = gcpDetect.processImage(camera.photo.path)
+    def importDetections(self, file):
+        """
+        Use the detections of the headless detection (gcp_detector/detectRecords.py) from this file
+        Images found in the file are not processed again, all others are detected as usual
+        """
+        self.importedDetections, params = readDetections(file)
+        print("Imported detections of {} images from {}, detector parameters: {}".format(len(self.importedDetections), file, params))
+
+    def _prefilterCameras(self, chunk, cameras):
+        """
+        Returns the cameras whose estimated ground footprint contains at least one marker, nearest first
+        Aligned cameras use the estimated position, others the EXIF GPS position.
+        Cameras without position or sensor information are always kept.
+        """
+        markers = [marker.reference.location for marker in chunk.markers if marker.reference.location]
+        if(len(markers) <= 0):
+            return cameras
+
+        # Work in a local metric frame (east, north, up) around the first marker
+        frame = ChunkUtils.getLocalFrame(chunk, markers[0])
+        def toLocal(v):
+            p = frame.mulp(v)
+            return [p.x, p.y, p.z]
+        marker_xyz = np.array([toLocal(chunk.crs.unproject(m)) for m in markers])
+        ground_z = np.median(marker_xyz[:, 2])
+
+        selected = [] # (distance, index, camera)
+        unknown = []
+        for index, (camera, position) in enumerate(zip(cameras, ChunkUtils.getCameraWorldPositions(chunk, cameras))):
+            radius = None
+            if(position is not None):
+                xyz = toLocal(position)
+                radius = ChunkUtils.getCameraFootprintRadius(camera, xyz[2] - ground_z)
+            if(radius is None):
+                unknown.append(camera)
+                continue
+
+            # The marker count is small, distances to all markers are calculated at once
+            distances = np.hypot(marker_xyz[:, 0] - xyz[0], marker_xyz[:, 1] - xyz[1])
+            nearest = distances.min()
+            if(nearest <= radius * self.PREFILTER_MARGIN):
+                selected.append((nearest, index, camera))
 
-        if(foundGCP != False):
-            # This camera contains a GCP - append it to camera label (for debugging)
-            camera.label += " [GCP]"
+        # Images with a marker close to the image center first
+        selected.sort(key=lambda tup: (tup[0], tup[1]))
+        return [camera for distance, index, camera in selected] + unknown
 
-            gcp_pixel_coords = Metashape.Vector(foundGCP)
+    def _predictGcpPixels(self, chunk, cameras):
+        """
+        Projects the marker reference locations into the aligned cameras
+        :return: [rois, roi_markers] rois is a dict {photo path: [(x, y), ...]} with the expected GCP pixel positions,
+                 roi_markers a dict {photo path: [marker label, ...]} with the markers of these positions.
+                 Not aligned cameras are missing
+        """
+        rois = {}
+        roi_markers = {}
+        if(not chunk.transform.matrix):
+            return rois, roi_markers
+        world_to_internal = chunk.transform.matrix.inv()
+        markers = [(marker.label, world_to_internal.mulp(chunk.crs.unproject(marker.reference.location)))
+                   for marker in chunk.markers if marker.reference.location]
 
-            # In the next step draw points in 3d world (with the matched gcps)
-            # First calc 3d coordinates from image pixel coordinates
-            point_internal = chunk.point_cloud.pickPoint(camera.center, camera.unproject(gcp_pixel_coords))
-            gcp_3d_world = chunk.crs.project(chunk.transform.matrix.mulp(point_internal))
-            # Then draw point at 3D coordinate
+        for camera in cameras:
+            if(not camera.transform): continue
+            width, height = camera.sensor.width, camera.sensor.height
+            points = []
+            labels = []
+            for label, marker_internal in markers:
+                pixel = camera.project(marker_internal)
+                if(pixel is None): continue
+                # The GCP may be visible although the predicted position is slightly outside the image
+                if(-self.detector.roi_size < pixel.x < width + self.detector.roi_size and
+                   -self.detector.roi_size < pixel.y < height + self.detector.roi_size):
+                    points.append((int(round(pixel.x)), int(round(pixel.y))))
+                    labels.append(label)
+            rois[camera.photo.path] = points
+            roi_markers[camera.photo.path] = sorted(labels)
+        return rois, roi_markers
+
+    def _detectImages(self, paths, rois = {}, roi_markers = {}):
+        # Yields the list of found GCPs for every path, always in the order of the given paths
+        # Imported and cached results are used directly, only the remaining images are decoded
+        # Images with known GCP positions (rois) are only searched around these positions
+        # Guided results are cached per searched markers, not per pixel position: the positions move by a few
+        # pixels whenever the cameras are optimized. A cached search of the whole image is used for guided images too
+        cached = {}
+        for path in paths:
+            imported = lookupDetections(self.importedDetections, path) if self.importedDetections else None
+            if(imported is not None):
+                # Detected on the whole image by the headless detection
+                cached[path] = imported
+                self.timer.count("imported")
+            elif(path in rois and len(rois[path]) <= 0):
+                # Aligned camera without any marker in view
+                cached[path] = []
+            elif(self.cache):
+                # A result of a search on the whole image is also valid for a guided search
+                found, result = self.cache.get(path, self._cacheKey(path, roi_markers), fallback = path in rois)
+                if(found):
+                    cached[path] = result
+
+        detected = self._runDetector([path for path in paths if path not in cached], rois)
+        for path in paths:
+            if(path in cached):
+                yield cached[path]
+                continue
+            foundGCPs = next(detected)
+            if(self.cache):
+                self.cache.put(path, foundGCPs, self._cacheKey(path, roi_markers))
+            yield foundGCPs
+
+        if(self.cache):
+            self.cache.commit()
+
+    def _cacheKey(self, path, roi_markers):
+        # Additional cache key of guided images, None for images searched as a whole
+        if(path not in roi_markers):
+            return None
+        return {"markers": roi_markers[path]}
+
+    def _runDetector(self, paths, rois = {}):
+        if(self.WORKERS <= 1 or len(paths) <= 1):
+            # Serial mode: the next images are read in background while the current one is analysed
+            for path, foundGCPs in self.detector.processImages(paths, queue_depth = self.PREFETCH_DEPTH, rois = rois):
+                self.timer.merge(self.detector.timer.pop())
+                yield foundGCPs
+            return
+
+        with self._createPool() as pool:
+            # map() submits all images at once, the workers are started while submitting
+            with self._workerMainModule():
+                results = pool.map(detectGcp, paths, [rois.get(path) for path in paths])
+            # map() returns the results in input order, so the result is identical to the serial run
+            for foundGCPs, timings in results:
+                self.timer.merge(timings)
+                yield foundGCPs
+
+    def _createPool(self):
+        if(self.POOL == "thread"):
+            # OpenCV releases the GIL while decoding and filtering, so threads scale well too
+            return ThreadPoolExecutor(max_workers=self.WORKERS, initializer=initDetectionWorker, initargs=(self.detector.getParams(),))
+
+        # Inside Metashape sys.executable is the Metashape binary, the workers have to be started
+        # with the python interpreter shipped with Metashape instead
+        ctx = multiprocessing.get_context("spawn")
+        python_exe = os.path.join(sys.exec_prefix, "python.exe" if sys.platform == "win32" else "bin/python3")
+        if(os.path.exists(python_exe)):
+            ctx.set_executable(python_exe)
+        return ProcessPoolExecutor(max_workers=self.WORKERS, mp_context=ctx, initializer=initDetectionWorker, initargs=(self.detector.getParams(),))
+
+    @contextmanager
+    def _workerMainModule(self):
+        # Spawned workers import the main module of the parent before they run anything. The main module is the
+        # processing script (e.g. 1_autoDEM.py), which would run the whole pipeline again in every worker, so the
+        # detector module is the main module while the workers are started
+        main_module = sys.modules["__main__"]
+        sys.modules["__main__"] = sys.modules[detectGcp.__module__]
+        try:
+            yield
+        finally:
+            sys.modules["__main__"] = main_module
+
+    def _pinDetections(self, chunk, detections):
+        """
+        Pins the nearest marker on every detected GCP
+        :param detections: list of (camera, foundGCPs), the GCPs of a camera ordered by likelihood
+        """
+        # In the next step the 3D world coordinates of all detections are calculated
+        picks = [] # (camera, pixel coords, 3D world coords)
+        world_transform = chunk.transform.matrix
+        with self.timer.stage("pick"):
+            for camera, foundGCPs in detections:
+                # This camera contains a GCP - append it to camera label (for debugging), only once on reruns
+                if(not camera.label.endswith(" [GCP]")):
+                    camera.label += " [GCP]"
+                for foundGCP in foundGCPs:
+                    gcp_pixel_coords = Metashape.Vector(foundGCP)
+                    # Calc 3d coordinates from image pixel coordinates
+                    point_internal = chunk.point_cloud.pickPoint(camera.center, camera.unproject(gcp_pixel_coords))
+                    if(point_internal is None):
+                        self.timer.count("pick_failed")
+                        continue
+                    picks.append((camera, gcp_pixel_coords, chunk.crs.project(world_transform.mulp(point_internal))))
+
+        # Then draw points at the 3D coordinates
+        for camera, gcp_pixel_coords, gcp_3d_world in picks:
             shape = chunk.shapes.addShape()
             shape.geometry = Metashape.Geometry.Point(gcp_3d_world)
 
-            # Next we estimate the nearest marker to the point by calculating distances from all markers
-            distanceList = [] # (marker, distance)
-
-            for marker in chunk.markers:
-                # Get a copy of the points and set the Z-Coordinate to zero to eliminate height measurement errors
-                marker_point = marker.reference.location.copy()
-                marker_point.z = 0
-                gcp_point = gcp_3d_world.copy()
-                gcp_point.z = 0
-
-                # Calc point distance
-                distance = (marker_point - gcp_point).norm()
-                # Create list of markers with distance as weight parameter
-                distanceList.append((marker, distance))
-            
-            # Now we can sort the markers list by ascending distance (shortest first)
-            distanceList.sort(key=lambda tup: tup[1], reverse=False)
-            # The nearest marker is now our first list item
-            bestMarker = distanceList[0][0]
-            bestMarkerDistance = distanceList[0][1]
-
-            # If distance to marker is under the distance threshould "pin" the marker
-            if(bestMarkerDistance < 0.0003):
-                bestMarker.projections[camera] = Metashape.Marker.Projection(gcp_pixel_coords, True)
+        markers = [marker for marker in chunk.markers if marker.reference.location]
+        if(len(picks) <= 0 or len(markers) <= 0):
+            return
 
-            app.update()
+        # Next we estimate the nearest marker of every point, distances to all markers are calculated at once
+        # The Z-Coordinate is ignored to eliminate height measurement errors
+        with self.timer.stage("assign"):
+            marker_xy = np.array([[marker.reference.location.x, marker.reference.location.y] for marker in markers])
+            gcp_xy = np.array([[gcp_3d_world.x, gcp_3d_world.y] for camera, gcp_pixel_coords, gcp_3d_world in picks])
+            distances = np.hypot(gcp_xy[:, np.newaxis, 0] - marker_xy[np.newaxis, :, 0],
+                                 gcp_xy[:, np.newaxis, 1] - marker_xy[np.newaxis, :, 1])
+            nearest = distances.argmin(axis=1)
+            nearest_distances = distances[np.arange(len(picks)), nearest]
 
-    def _unpinBadMarkers(self, chunk, errorThreshold = 80000):
-        # After setting markers automatically some of them may be false and increase the model error
-        # This function unpins markers above a threshold level
-        for marker in chunk.markers:
-            for camera in chunk.cameras:
-                # If marker is not pinned on this camera continue
-                if not camera in marker.projections.keys():
-                    continue
+        # If distance to marker is under the distance threshould "pin" the marker
+        # GCPs are ordered by likelihood, a marker is only pinned once per camera
+        # Existing projections (of an earlier run or corrected by hand) are kept
+        pinnedMarkers = set() # (camera key, marker index)
+        for (camera, gcp_pixel_coords, gcp_3d_world), index, distance in zip(picks, nearest, nearest_distances):
+            if(distance < self.MARKER_MAX_DISTANCE and (camera.key, index) not in pinnedMarkers and not markers[index].projections[camera]):
+                markers[index].projections[camera] = Metashape.Marker.Projection(gcp_pixel_coords, True)
+                pinnedMarkers.add((camera.key, index))
+                self.timer.count("pinned")
 
-                # 2 dimensional vector of the marker projection on the photo
-                v_proj = marker.projections[camera].coord 
+    def _unpinBadMarkers(self, chunk, maxIterations = 10):
+        """
+        After setting markers automatically some of them may be false and increase the model error
+        This function unpins projections with outlying reprojection errors (in pixels):
+        - errors above UNPIN_MAX_ERROR are always removed
+        - of the remaining ones, errors above median + UNPIN_MAD_FACTOR * MAD are removed, the median and
+          MAD are estimated again on the kept projections until no more projection is removed
+        - errors below UNPIN_MIN_ERROR are always kept
+        """
+        # Only the existing projections are visited
+        projections = [] # (marker, camera)
+        coords = []      # (pinned x, pinned y, reprojected x, reprojected y)
+        for marker in chunk.markers:
+            if(marker.position is None): continue
+            for camera, projection in marker.projections.items():
                 # 2 dimensional vector of projected 3D marker position
-                v_reproj = camera.project(marker.position) 
-                
-                # Calc the reprojection error for current photo
-                diff = (v_proj - v_reproj).norm() ** 2 
-                    
-                print(marker.label + " " + camera.label + "Error: " + str(diff))
-
-                # Remove (Unpin) markers with error value above threshold
-                if(diff > errorThreshold):
-                    marker.projections[camera] = None
-                    print("Removed bad marker on camera " + camera.label)
\ No newline at end of file
+                v_reproj = camera.project(marker.position) if camera.transform else None
+                if(v_reproj is None): continue
+                projections.append((marker, camera))
+                coords.append((projection.coord.x, projection.coord.y, v_reproj.x, v_reproj.y))
+        if(len(projections) <= 0):
+            return
+
+        # Reprojection errors of all projections at once
+        coords = np.array(coords)
+        errors = np.hypot(coords[:, 0] - coords[:, 2], coords[:, 1] - coords[:, 3])
+
+        keep = errors <= self.UNPIN_MAX_ERROR
+        for i in range(maxIterations):
+            if(not keep.any()): break
+            median = np.median(errors[keep])
+            # Scaled MAD, equals the standard deviation for normal distributed errors
+            mad = 1.4826 * np.median(np.abs(errors[keep] - median))
+            limit = max(median + self.UNPIN_MAD_FACTOR * mad, self.UNPIN_MIN_ERROR)
+            updated = keep & (errors <= limit)
+            if((updated == keep).all()): break
+            keep = updated
+        print("Marker reprojection errors: median {:.2f} px, max {:.2f} px, {} of {} projections removed".format(
+            np.median(errors), errors.max(), int((~keep).sum()), len(errors)))
+
+        # Remove (Unpin) the bad projections
+        for (marker, camera), error in zip(itertools.compress(projections, ~keep), errors[~keep]):
+            marker.projections[camera] = None
+            self.timer.count("unpinned")
+            print("Removed bad marker " + marker.label + " on camera " + camera.label + " Error: {:.2f} px".format(error))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+""" Render synthetic aerial images with ground control points at known positions (for benchmarks)"""
+
+import os
+import math
+import cv2
+import numpy as np
+
+# Target patterns: "checker" has two black and two white quadrants,
+# "hourglass" two black triangles meeting in the center
+PATTERNS = ["checker", "hourglass"]
+
+
+def renderField(width, height, rng):
+    """Field texture: green vegetation with soil patches, low and high frequency variation"""
+    # Low frequency patches (soil / vegetation) from upscaled noise
+    patches = cv2.resize(rng.random((max(2, height // 200), max(2, width // 200))).astype(np.float32),
+                         (width, height), interpolation=cv2.INTER_CUBIC)
+    vegetation = np.clip(patches * 1.6 - 0.3, 0, 1)
+
+    hsv = np.empty((height, width, 3), dtype=np.float32)
+    hsv[..., 0] = 15 + vegetation * 30 + rng.normal(0, 3, (height, width))      # brown -> green
+    hsv[..., 1] = 90 + vegetation * 80 + rng.normal(0, 20, (height, width))     # saturated colors
+    hsv[..., 2] = 80 + patches * 60 + rng.normal(0, 30, (height, width))
+    hsv = np.clip(hsv, 0, [179, 255, 255]).astype(np.uint8)
+    img = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+    return cv2.GaussianBlur(img, (3, 3), 0.8)
+
+
+def renderTarget(img, center, size, angle = 0, pattern = "checker", supersampling = 4):
+    """
+    Draws a square GCP target in place, anti aliased by supersampling
+    :param center: sub pixel position (x, y), pixel centers are at integer coordinates
+    :param size: edge length of the target in pixels
+    """
+    cX, cY = center
+    reach = int(math.ceil(size * 0.75)) + 1
+    x0, x1 = max(0, int(cX) - reach), min(img.shape[1], int(cX) + reach + 1)
+    y0, y1 = max(0, int(cY) - reach), min(img.shape[0], int(cY) + reach + 1)
+    if x1 <= x0 or y1 <= y0:
+        return
+
+    ys, xs = np.mgrid[y0:y1, x0:x1].astype(np.float64)
+    sub = (np.arange(supersampling) + 0.5) / supersampling - 0.5
+    white = np.zeros(xs.shape)
+    inside = np.zeros(xs.shape)
+    cos, sin = math.cos(angle), math.sin(angle)
+    for dy in sub:
+        for dx in sub:
+            X = xs + dx - cX
+            Y = ys + dy - cY
+            u = X * cos + Y * sin
+            v = -X * sin + Y * cos
+            sample_inside = (np.abs(u) < size / 2) & (np.abs(v) < size / 2)
+            if pattern == "hourglass":
+                sample_white = sample_inside & (np.abs(v) > np.abs(u))
+            else:
+                sample_white = sample_inside & ((u > 0) == (v > 0))
+            inside += sample_inside
+            white += sample_white
+    samples = supersampling ** 2
+    inside /= samples
+    white /= samples
+
+    target = (white * 240 + (inside - white) * 20)[..., np.newaxis]
+    patch = img[y0:y1, x0:x1].astype(np.float64)
+    img[y0:y1, x0:x1] = np.clip(patch * (1 - inside[..., np.newaxis]) + target, 0, 255).astype(np.uint8)
+
+
+def generateImage(width, height, rng, targets = 1, size_range = (20, 40), blur_range = (0, 1.2),
+                  noise_range = (0, 6), exposure_range = (0.8, 1.2)):
+    """
+    Renders one synthetic aerial image
+    :return: [image, truths] truths is the list of target centers (x, y)
+    """
+    img = renderField(width, height, rng)
+
+    truths = []
+    margin = size_range[1] * 2
+    for i in range(targets):
+        for attempt in range(20):
+            center = (rng.uniform(margin, width - margin), rng.uniform(margin, height - margin))
+            # Targets must not overlap
+            if all(math.dist(center, t) > margin * 2 for t in truths):
+                break
+        size = rng.uniform(*size_range)
+        renderTarget(img, center, size, rng.uniform(0, math.pi / 2), PATTERNS[rng.integers(len(PATTERNS))])
+        truths.append(center)
+
+    # Camera effects: defocus / motion blur, exposure and sensor noise
+    sigma = rng.uniform(*blur_range)
+    if sigma > 0.1:
+        img = cv2.GaussianBlur(img, (0, 0), sigma)
+    img = img.astype(np.float32) * rng.uniform(*exposure_range)
+    img += rng.normal(0, rng.uniform(*noise_range), img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8), truths
+
+
+def generateDataset(folder, count, width, height, seed = 0, quality = 90, **kwargs):
+    """
+    Writes count synthetic JPEG images to folder, identical seeds give identical images
+    :return: list of [path, truths]
+    """
+    rng = np.random.default_rng(seed)
+    dataset = []
+    for i in range(count):
+        img, truths = generateImage(width, height, rng, **kwargs)
+        path = os.path.join(folder, "synthetic_{}x{}_{:04d}.jpg".format(width, height, i))
+        cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tofile(path)
+        dataset.append((path, truths))
+    return dataset
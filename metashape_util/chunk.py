@@ -25,6 +25,12 @@ class ChunkUtils:
 				return True
 		return False
 
+	def getUnalignedCameras(chunk):
+		"""
+		Returns the cameras with photo but without transform information
+		"""
+		return [camera for camera in chunk.cameras if camera.photo and not camera.transform]
+
 	def hasChunkPointCloud(chunk):
 		"""
 		Returns true if chunk has a point cloud
@@ -76,6 +82,46 @@ class ChunkUtils:
 		if (n == 0): return None
 		return (sumErrors / n) ** 0.5
 
+	def getLocalFrame(chunk, origin):
+		"""
+		Matrix transforming geocentric coordinates to local east, north, up coordinates in meters
+		:param origin: origin of the local frame in chunk crs coordinates
+		"""
+		return chunk.crs.localframe(chunk.crs.unproject(origin))
+
+	def getCameraWorldPositions(chunk, cameras):
+		"""
+		Geocentric position of every camera. Aligned cameras use the estimated position,
+		not aligned cameras the reference location (EXIF GPS)
+		:return: list with Metashape.Vector or None if the position is unknown
+		"""
+		positions = []
+		for camera in cameras:
+			if camera.transform and chunk.transform.matrix:
+				positions.append(chunk.transform.matrix.mulp(camera.center))
+			elif camera.reference.location:
+				positions.append(chunk.crs.unproject(camera.reference.location))
+			else:
+				positions.append(None)
+		return positions
+
+	def getCameraFootprintRadius(camera, height):
+		"""
+		Radius in meters of the ground area visible on a nadir image taken at height meters above ground
+		:return: radius or None if the sensor is not calibrated
+		"""
+		sensor = camera.sensor
+		if not sensor or not sensor.width or not sensor.height:
+			return None
+		if sensor.calibration and sensor.calibration.f:
+			focal_px = sensor.calibration.f
+		elif sensor.focal_length and sensor.pixel_width:
+			focal_px = sensor.focal_length / sensor.pixel_width
+		else:
+			return None
+		half_diagonal_px = ((sensor.width ** 2 + sensor.height ** 2) ** 0.5) / 2
+		return abs(height) * half_diagonal_px / focal_px
+
 	def drawPolygon(chunk, coordinates, label = False):
 		if not chunk.shapes:
 			chunk.shapes = Metashape.Shapes()
@@ -0,0 +1,144 @@
+import os
+import sys
+import math
+import argparse
+import configparser
+
+try:
+	import rasterio
+	import rasterio.shutil
+	from rasterio.errors import RasterioError
+except ImportError:
+	rasterio = None
+
+class CogExport:
+	"""
+	Export of the DEM as Cloud Optimized GeoTIFF: internally tiled, compressed (with predictor) and with overviews.
+	Metashape writes a tiled and compressed GeoTIFF with overviews. If rasterio is installed the file is
+	rewritten with the COG layout (overviews before the image data) and the predictor, and verified.
+	Parcel reads (2_compareDEM.py) only read the tiles of the parcel instead of whole rows of the DEM.
+	Existing DEMs can be converted with: python -m metashape_util.cog_export dem1.tif dem2.tif
+	"""
+	COMPRESSIONS = ["deflate", "lzw"]
+
+	def __init__(self, config):
+		self.FORMAT = config.get("DEM_EXPORT_FORMAT", "cog").strip().lower()
+		self.COMPRESSION = config.get("DEM_COMPRESSION", "deflate").strip().lower()
+		if(self.COMPRESSION not in self.COMPRESSIONS):
+			print("Unknown DEM_COMPRESSION {}, using deflate".format(self.COMPRESSION))
+			self.COMPRESSION = "deflate"
+		self.BLOCK_SIZE = config.getint("DEM_BLOCK_SIZE", 512)
+		self.POSTPROCESS = config.getboolean("DEM_COG_POSTPROCESS", True)
+
+	def getExportParams(self):
+		# Additional parameters of chunk.exportRaster(), plain strip tiffs without compression for DEM_EXPORT_FORMAT: tiff
+		if(self.FORMAT != "cog"):
+			return {}
+		import Metashape
+		compression = Metashape.ImageCompression()
+		compression.tiff_tiled = True
+		compression.tiff_overviews = True
+		compression.tiff_big = True
+		compression.tiff_compression = {
+			"deflate": Metashape.ImageCompression.TiffCompressionDeflate,
+			"lzw": Metashape.ImageCompression.TiffCompressionLZW
+		}[self.COMPRESSION]
+		return {"image_compression": compression}
+
+	def postprocess(self, path):
+		"""
+		Rewrites the exported DEM as COG, the Metashape export is kept if rasterio is missing or the check fails
+		:return: True if the file was converted
+		"""
+		if(self.FORMAT != "cog" or not self.POSTPROCESS):
+			return False
+		if(rasterio is None):
+			print("rasterio is not installed, the DEM is kept as exported by Metashape (tiled, without COG layout)")
+			return False
+		return self.convert(path)
+
+	def convert(self, path):
+		"""
+		Converts the GeoTIFF to COG, written to a temporary file which replaces the file after the verification
+		:return: True if the file was converted
+		"""
+		# Not a .tif name, a file left by a crash is not taken for a DEM (e.g. by 2_compareDEM.py)
+		tmp_path = os.path.splitext(path)[0] + ".cog.partial"
+		size = os.path.getsize(path)
+		try:
+			try:
+				try:
+					# COG driver of GDAL >= 3.1, overviews are calculated, PREDICTOR=YES chooses the predictor of the data type
+					rasterio.shutil.copy(path, tmp_path, driver="COG", compress=self.COMPRESSION, predictor="YES",
+										 blocksize=self.BLOCK_SIZE, overviews="AUTO", bigtiff="IF_SAFER")
+				except RasterioError:
+					# Older GDAL: tiled GeoTIFF, the overviews of the Metashape export are copied
+					with rasterio.open(path) as src:
+						predictor = 3 if src.dtypes[0].startswith("float") else 2
+					rasterio.shutil.copy(path, tmp_path, driver="GTiff", tiled=True, blockxsize=self.BLOCK_SIZE, blockysize=self.BLOCK_SIZE,
+										 compress=self.COMPRESSION, predictor=predictor, copy_src_overviews=True, bigtiff="IF_SAFER")
+				errors = self.verify(path, tmp_path)
+			except RasterioError as e:
+				errors = [str(e)]
+			if(len(errors) > 0):
+				print("Warning: COG conversion of {} failed, keeping the exported file: {}".format(path, "; ".join(errors)))
+				return False
+
+			os.replace(tmp_path, path)
+		finally:
+			# Also removed on any other error (e.g. disk full or out of memory)
+			if(os.path.exists(tmp_path)):
+				os.remove(tmp_path)
+		print("Converted {} to COG: {:.1f} MB -> {:.1f} MB".format(path, size / 1024**2, os.path.getsize(path) / 1024**2))
+		return True
+
+	def verify(self, source_path, cog_path):
+		"""
+		Checks that the COG has the georeference and the (lossless compressed) values of the source
+		and is tiled, compressed and has overviews
+		:return: list of errors, empty if the COG is valid
+		"""
+		errors = []
+		with rasterio.open(source_path) as src, rasterio.open(cog_path) as cog:
+			for name in ["width", "height", "count", "crs", "transform", "dtypes"]:
+				if(getattr(src, name) != getattr(cog, name)):
+					errors.append("{} differs".format(name))
+			if(not self.isSameNodata(src.nodata, cog.nodata)):
+				errors.append("nodata differs")
+			if(cog.profile.get("tiled") is not True):
+				errors.append("not tiled")
+			if(cog.compression is None):
+				errors.append("not compressed")
+			# Small DEMs fit into one tile and need no overviews
+			if(max(cog.width, cog.height) > self.BLOCK_SIZE and len(cog.overviews(1)) <= 0):
+				errors.append("no overviews")
+			if(len(errors) <= 0):
+				for band in range(1, src.count + 1):
+					if(src.checksum(band) != cog.checksum(band)):
+						errors.append("values of band {} differ".format(band))
+		return errors
+
+	@staticmethod
+	def isSameNodata(a, b):
+		# NaN nodata (float DEMs) is never equal to itself
+		if(a is None or b is None):
+			return a is b
+		return a == b or (math.isnan(a) and math.isnan(b))
+
+
+if __name__ == "__main__":
+	# Converts existing DEM exports, settings from section [Export] of config.ini
+	parser = argparse.ArgumentParser(description="Converts GeoTIFF DEMs to Cloud Optimized GeoTIFFs (in place)")
+	parser.add_argument("paths", nargs="+", help="GeoTIFF files")
+	parser.add_argument("--config", dest="config_path", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.ini"))
+	args = parser.parse_args()
+	if(rasterio is None):
+		sys.exit("rasterio is required")
+
+	config = configparser.ConfigParser()
+	config.read(args.config_path)
+	if(not config.has_section("Export")):
+		config.add_section("Export")
+	cog = CogExport(config["Export"])
+	failed = [path for path in args.paths if not cog.convert(path)]
+	sys.exit(1 if failed else 0)
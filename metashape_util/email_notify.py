@@ -1,27 +1,149 @@
+import time
+import queue
 import smtplib
+import threading
+from datetime import datetime
 from email.utils import formatdate
 from email.mime.text import MIMEText
 
 class EmailNotify:
-    def __init__(self, config):
+    """
+    Sends the notification emails in a background thread, the script never waits for the mail server.
+    Messages are queued (at most EMAIL_QUEUE_SIZE), failed sends are retried with increasing delay and
+    the connection to the server is reused for following messages.
+    Chunk events (aligned, GCP failed, DEM exported) are collected and sent as one digest email
+    every EMAIL_DIGEST_INTERVAL seconds and when the script ends.
+    """
+    # Seconds an unused connection is kept open, mail servers close idle connections
+    IDLE_TIMEOUT = 60
+    # Seconds the exception hook waits for the error email, an unreachable server must not block the exit
+    EXCEPTION_TIMEOUT = 5
+
+    def __init__(self, config, smtp_factory = smtplib.SMTP):
+        """
+        :param smtp_factory: class creating the smtp connection, called with timeout=SMTP_TIMEOUT
+        """
         self.ACTIVE = config.getboolean("SEND_EMAIL_NOTIFICATION", False)
+        self.smtp_factory = smtp_factory
         if(self.ACTIVE):
-            self.SMTP_SERVER = config.get("SMTP_SERVER")
+            self.SMTP_SERVER = config.get("SMTP_SERVER", "")
             self.SMTP_PORT = config.getint("SMTP_PORT", 587)
-            self.SMTP_USER = config.get("SMTP_USER")
-            self.SMTP_PASS = config.get("SMTP_PASS")
-            self.TO_EMAIL = config.get("TO_EMAIL")
+            self.SMTP_USER = config.get("SMTP_USER", "")
+            self.SMTP_PASS = config.get("SMTP_PASS", "")
+            self.TO_EMAIL = config.get("TO_EMAIL", "")
+            self.STARTTLS = config.getboolean("SMTP_STARTTLS", True)
+            # Seconds until connecting or a single command of the mail server fails
+            self.SMTP_TIMEOUT = config.getfloat("SMTP_TIMEOUT", 30)
+            self.QUEUE_SIZE = config.getint("EMAIL_QUEUE_SIZE", 100)
+            self.RETRIES = config.getint("EMAIL_RETRIES", 5)
+            self.RETRY_DELAY = config.getfloat("EMAIL_RETRY_DELAY", 10)
+            self.DIGEST_INTERVAL = config.getfloat("EMAIL_DIGEST_INTERVAL", 3600)
 
             if self.SMTP_SERVER.strip() == "" or \
             self.SMTP_USER.strip() == "" or \
             self.SMTP_PASS.strip() == "" or \
-            self.TO_EMAIL.strip() == "": 
+            self.TO_EMAIL.strip() == "":
                 print("Email Settings are not set properly.")
                 self.ACTIVE = False
 
+        self.project = ""
+        self.sent = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=self.QUEUE_SIZE if self.ACTIVE else 0)
+        self._events = []
+        self._lock = threading.Lock()
+        self._last_digest = time.time()
+        self._smtp = None
+        self._worker = None
+
     def notify(self, subject, text):
+        # Queues the message and returns immediately
         if not self.ACTIVE: return
+        self._startWorker()
+        try:
+            self._queue.put_nowait((subject, text))
+        except queue.Full:
+            print("Email queue is full, message dropped: " + subject)
+
+    def event(self, chunk, name, text = ""):
+        """
+        Adds an event of a chunk to the next digest email
+        :param name: e.g. aligned, gcp_failed, dem_exported
+        """
+        if not self.ACTIVE: return
+        label = chunk.label if hasattr(chunk, "label") else chunk
+        with self._lock:
+            self._events.append("{}\t{}\t{}\t{}".format(datetime.now().strftime("%H:%M:%S"), label, name, text))
+        self._startWorker()
+
+    def close(self, timeout = 60):
+        """
+        Sends the remaining events and waits at most timeout seconds in total for the queued messages
+        Called at the end of the script, Metashape may quit afterwards
+        """
+        if not self.ACTIVE or self._worker is None: return
+        deadline = time.time() + timeout
+        self._queueDigest()
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            print("Email queue is full, remaining messages are dropped")
+            return
+        self._worker.join(max(0, deadline - time.time()))
+        if self._worker.is_alive():
+            print("Email worker did not finish within {} s, remaining messages are dropped".format(timeout))
+        self._worker = None
 
+    def _startWorker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="EmailNotify", daemon=True)
+            self._worker.start()
+
+    def _queueDigest(self):
+        with self._lock:
+            events, self._events = self._events, []
+            self._last_digest = time.time()
+        if len(events) <= 0: return
+        text = "Time\tChunk\tEvent\tDetails\n" + "\n".join(events)
+        try:
+            self._queue.put_nowait(("Progress of {}: {} events".format(self.project, len(events)), text))
+        except queue.Full:
+            print("Email queue is full, digest of {} events dropped".format(len(events)))
+
+    def _run(self):
+        while True:
+            try:
+                message = self._queue.get(timeout=min(self.IDLE_TIMEOUT, max(1, self.DIGEST_INTERVAL)))
+            except queue.Empty:
+                message = False
+            if message is None:
+                break
+            if message:
+                self._sendWithRetry(*message)
+            elif self._smtp is not None:
+                self._disconnect()
+            if self.DIGEST_INTERVAL > 0 and time.time() - self._last_digest >= self.DIGEST_INTERVAL:
+                self._queueDigest()
+        self._disconnect()
+
+    def _sendWithRetry(self, subject, text):
+        delay = self.RETRY_DELAY
+        for attempt in range(self.RETRIES + 1):
+            try:
+                self._send(subject, text)
+                self.sent += 1
+                print("Email sent successfully!")
+                return
+            except Exception as ex:
+                # A broken connection is opened again on the next attempt
+                self._disconnect()
+                print("Email send failed (attempt {} of {}): {}".format(attempt + 1, self.RETRIES + 1, ex))
+                if attempt < self.RETRIES:
+                    time.sleep(delay)
+                    delay *= 2
+        self.failed += 1
+
+    def _send(self, subject, text):
         msg = MIMEText(text)
 
         msg['Subject'] = subject
@@ -29,20 +151,36 @@ class EmailNotify:
         msg['To'] = self.TO_EMAIL
         msg["Date"] = formatdate(localtime=True)
 
+        if self._smtp is not None:
+            # The server may have closed the connection in the meantime
+            try:
+                if self._smtp.noop()[0] != 250:
+                    self._disconnect()
+            except (smtplib.SMTPException, OSError):
+                self._disconnect()
+        if self._smtp is None:
+            self._connect()
+        self._smtp.sendmail(self.SMTP_USER, self.TO_EMAIL, msg.as_string())
 
-        try:    
-            smtp = smtplib.SMTP()
-            smtp._host = self.SMTP_SERVER
-            smtp.connect(self.SMTP_SERVER, self.SMTP_PORT)
-            smtp.starttls() 
+    def _connect(self):
+        smtp = self.smtp_factory(timeout=self.SMTP_TIMEOUT)
+        smtp._host = self.SMTP_SERVER
+        smtp.connect(self.SMTP_SERVER, self.SMTP_PORT)
+        if self.STARTTLS:
+            smtp.starttls()
+        smtp.ehlo_or_helo_if_needed()
+        # Local test servers do not support authentication
+        if smtp.has_extn("auth"):
             smtp.login(self.SMTP_USER, self.SMTP_PASS)
-            smtp.sendmail(self.SMTP_USER, self.TO_EMAIL, msg.as_string())
-            smtp.quit()
+        self._smtp = smtp
 
-            print("Email sent successfully!")
-        except Exception as ex:
-            print("Email send failed!")
-            print("Something went wrong….",ex)
+    def _disconnect(self):
+        if self._smtp is None: return
+        try:
+            self._smtp.quit()
+        except Exception:
+            pass
+        self._smtp = None
 
     def exeptionHandler(self, project, type, value, tback):
         content = """
@@ -51,5 +189,6 @@ class EmailNotify:
         Value: {value}
         StackTrace: {tb}
         """.format(type=type, value = value, tb=tback)
-        
-        self.notify("ERROR in {}".format(project), content)
\ No newline at end of file
+
+        self.notify("ERROR in {}".format(project), content)
+        self.close(timeout = self.EXCEPTION_TIMEOUT)
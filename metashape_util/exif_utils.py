@@ -0,0 +1,156 @@
+import re
+import struct
+import calendar
+from datetime import datetime
+
+# EXIF and XMP are stored in the first segments of the jpeg file, parseHeader() needs this part of the file
+HEADER_READ_SIZE = 128 * 1024
+
+# EXIF tags
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_SUBSEC_ORIGINAL = 0x9291
+TAG_GPS_LATITUDE_REF = 0x0001
+TAG_GPS_LATITUDE = 0x0002
+TAG_GPS_LONGITUDE_REF = 0x0003
+TAG_GPS_LONGITUDE = 0x0004
+TAG_GPS_ALTITUDE_REF = 0x0005
+TAG_GPS_ALTITUDE = 0x0006
+
+# Size in bytes of the EXIF value types
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+# XMP attributes written by DJI drones, e.g. drone-dji:RelativeAltitude="+30.10"
+XMP_PATTERN = re.compile(rb'drone-dji:(RelativeAltitude|GimbalYawDegree|GimbalPitchDegree|FlightYawDegree)="([^"]*)"')
+XMP_KEYS = {
+	b"RelativeAltitude": "relative_altitude",
+	b"GimbalYawDegree": "gimbal_yaw",
+	b"GimbalPitchDegree": "gimbal_pitch",
+	b"FlightYawDegree": "flight_yaw"
+}
+
+class ExifUtils:
+	def readHeader(path):
+		"""
+		Reads capture time, GPS position and the DJI XMP values of a jpeg image without decoding it
+		Only the APP1 segments (EXIF and XMP) at the beginning of the file are read, all others are skipped
+		:return: dict with the found keys of: time (unix timestamp, camera clock), latitude, longitude,
+			altitude, relative_altitude, gimbal_yaw, gimbal_pitch, flight_yaw
+		"""
+		header = {}
+		with open(path, "rb") as f:
+			if(f.read(2) != b"\xFF\xD8"):
+				return header
+			while True:
+				segment_header = f.read(4)
+				if(len(segment_header) < 4 or segment_header[0] != 0xFF or segment_header[1] == 0xDA):
+					break
+				length = struct.unpack(">H", segment_header[2:4])[0]
+				# The length includes its own 2 bytes, smaller values are corrupt (read(-n) would read the whole file)
+				if(length < 2):
+					break
+				if(segment_header[1] == 0xE1):
+					header.update(ExifUtils._parseApp1(f.read(length - 2)))
+				else:
+					f.seek(length - 2, 1)
+		return header
+
+	def parseHeader(data):
+		# Same as readHeader() for the already read (beginning of the) file content
+		header = {}
+		for marker, segment in ExifUtils._segments(data):
+			if(marker == 0xE1):
+				header.update(ExifUtils._parseApp1(segment))
+		return header
+
+	def _parseApp1(segment):
+		# APP1 segments contain either EXIF or XMP data
+		if(segment.startswith(b"Exif\x00\x00")):
+			return ExifUtils._parseExif(segment[6:])
+		header = {}
+		if(segment.startswith(b"http://ns.adobe.com/xap/1.0/")):
+			for key, value in XMP_PATTERN.findall(segment):
+				try:
+					header[XMP_KEYS[key]] = float(value)
+				except ValueError:
+					pass
+		return header
+
+	def _segments(data):
+		# Yields (marker, content) of the jpeg segments before the image data
+		if(data[:2] != b"\xFF\xD8"):
+			return
+		pos = 2
+		while pos + 4 <= len(data):
+			if(data[pos] != 0xFF):
+				return
+			marker = data[pos + 1]
+			if(marker == 0xDA): # start of scan, image data follows
+				return
+			length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+			if(length < 2): # corrupt segment length
+				return
+			yield marker, data[pos + 4:pos + 2 + length]
+			pos += 2 + length
+
+	def _parseExif(tiff):
+		result = {}
+		try:
+			order = "<" if tiff[:2] == b"II" else ">"
+			ifd0 = ExifUtils._readIfd(tiff, order, struct.unpack(order + "I", tiff[4:8])[0])
+
+			if(TAG_EXIF_IFD in ifd0):
+				exif = ExifUtils._readIfd(tiff, order, ifd0[TAG_EXIF_IFD][0])
+				if(TAG_DATETIME_ORIGINAL in exif):
+					taken = datetime.strptime(exif[TAG_DATETIME_ORIGINAL].strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+					result["time"] = float(calendar.timegm(taken.timetuple()))
+					subsec = exif.get(TAG_SUBSEC_ORIGINAL, "").strip("\x00 ")
+					if(subsec.isdigit()):
+						result["time"] += float("0." + subsec)
+
+			if(TAG_GPS_IFD in ifd0):
+				gps = ExifUtils._readIfd(tiff, order, ifd0[TAG_GPS_IFD][0])
+				if(TAG_GPS_LATITUDE in gps and TAG_GPS_LONGITUDE in gps):
+					lat = ExifUtils._degrees(gps[TAG_GPS_LATITUDE])
+					lon = ExifUtils._degrees(gps[TAG_GPS_LONGITUDE])
+					result["latitude"] = -lat if gps.get(TAG_GPS_LATITUDE_REF, "N").startswith("S") else lat
+					result["longitude"] = -lon if gps.get(TAG_GPS_LONGITUDE_REF, "E").startswith("W") else lon
+				if(TAG_GPS_ALTITUDE in gps):
+					alt = gps[TAG_GPS_ALTITUDE][0]
+					result["altitude"] = -alt if gps.get(TAG_GPS_ALTITUDE_REF, [0])[0] == 1 else alt
+		except (struct.error, ValueError, IndexError, ZeroDivisionError):
+			# Broken or unusual EXIF data, use what was found so far
+			pass
+		return result
+
+	def _readIfd(tiff, order, offset):
+		# Returns {tag: value} of an image file directory, ascii values as str, numbers as list
+		entries = {}
+		count = struct.unpack(order + "H", tiff[offset:offset + 2])[0]
+		for i in range(count):
+			entry = offset + 2 + i * 12
+			tag, value_type, value_count = struct.unpack(order + "HHI", tiff[entry:entry + 8])
+			if(value_type not in TYPE_SIZES): continue
+			size = TYPE_SIZES[value_type] * value_count
+			if(size <= 4):
+				raw = tiff[entry + 8:entry + 8 + size]
+			else:
+				value_offset = struct.unpack(order + "I", tiff[entry + 8:entry + 12])[0]
+				raw = tiff[value_offset:value_offset + size]
+			entries[tag] = ExifUtils._decodeValue(raw, order, value_type, value_count)
+		return entries
+
+	def _decodeValue(raw, order, value_type, count):
+		if(value_type == 2):
+			return raw.decode("ascii", errors="replace")
+		if(value_type in (5, 10)):
+			fmt = "I" if value_type == 5 else "i"
+			numbers = struct.unpack(order + fmt * (2 * count), raw)
+			return [numbers[i] / numbers[i + 1] if numbers[i + 1] else 0.0 for i in range(0, len(numbers), 2)]
+		fmt = {1: "B", 3: "H", 4: "I", 7: "B", 9: "i"}[value_type]
+		return list(struct.unpack(order + fmt * count, raw))
+
+	def _degrees(dms):
+		# [degrees, minutes, seconds] to decimal degrees
+		return dms[0] + dms[1] / 60 + dms[2] / 3600
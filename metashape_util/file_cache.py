@@ -0,0 +1,109 @@
+import os
+import re
+import json
+import hashlib
+import sqlite3
+
+class FileCache:
+	"""
+	Persistent cache of results computed from a file, stored as SQLite database
+	The key is the path, size and modification time of the file and the hash of the parameters of the computation,
+	a modified file or a changed parameter invalidates the result. Results must be json serializable.
+	Usage:
+		cache = FileCache(db_path, {"version": 1})
+		found, result = cache.get(path)
+		if(not found):
+			cache.put(path, compute(path))
+		cache.commit()
+	"""
+	# Results are written to disk after this number of new entries
+	COMMIT_INTERVAL = 50
+
+	def __init__(self, db_path, params, table = "results"):
+		"""
+		:param params: parameters of the computation, changing a parameter invalidates old results
+		:param table: name of the table of the results
+		"""
+		if(not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", table)):
+			raise ValueError("Invalid cache table name: {}".format(table))
+		self.table = table
+		self.params_hash = hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+		self.hits = 0
+		self.misses = 0
+		self._pending = 0
+
+		self.conn = sqlite3.connect(db_path)
+		self.conn.execute("""
+			CREATE TABLE IF NOT EXISTS {} (
+				path TEXT NOT NULL,
+				size INTEGER NOT NULL,
+				mtime INTEGER NOT NULL,
+				params TEXT NOT NULL,
+				result TEXT NOT NULL,
+				PRIMARY KEY (path, params)
+			)""".format(self.table))
+		self.conn.commit()
+
+	def _fileKey(self, path):
+		st = os.stat(path)
+		return os.path.normcase(os.path.abspath(path)), st.st_size, st.st_mtime_ns
+
+	def _paramsKey(self, extra):
+		# Additional inputs of a single file extend the parameter hash
+		# The inputs must not change between runs with the same result
+		if extra is None:
+			return self.params_hash
+		return hashlib.sha1((self.params_hash + json.dumps(extra, sort_keys=True)).encode("utf-8")).hexdigest()
+
+	def get(self, path, extra = None, fallback = False):
+		"""
+		Look up the result of a file
+		:param extra: additional inputs of this file, part of the key
+		:param fallback: if no result with extra exists, use the result computed without extra inputs
+		:return: [found, result] found is False if the file is not in the cache or was modified since
+		"""
+		try:
+			key, size, mtime = self._fileKey(path)
+		except OSError:
+			self.misses += 1
+			return False, None
+
+		params = [self._paramsKey(extra)]
+		if fallback and extra is not None:
+			params.append(self.params_hash)
+		# The result with extra inputs first
+		row = self.conn.execute(
+			"SELECT result FROM {} WHERE path = ? AND params IN ({}) AND size = ? AND mtime = ? ORDER BY params = ? DESC LIMIT 1".format(
+				self.table, ", ".join("?" * len(params))),
+			(key, *params, size, mtime, params[0])).fetchone()
+		if row is None:
+			self.misses += 1
+			return False, None
+
+		self.hits += 1
+		return True, json.loads(row[0])
+
+	def put(self, path, result, extra = None):
+		try:
+			key, size, mtime = self._fileKey(path)
+		except OSError:
+			return
+		self.conn.execute(
+			"INSERT OR REPLACE INTO {} (path, size, mtime, params, result) VALUES (?, ?, ?, ?, ?)".format(self.table),
+			(key, size, mtime, self._paramsKey(extra), json.dumps(result)))
+
+		self._pending += 1
+		if self._pending >= self.COMMIT_INTERVAL:
+			self.commit()
+
+	def commit(self):
+		self.conn.commit()
+		self._pending = 0
+
+	def resetCounters(self):
+		self.hits = 0
+		self.misses = 0
+
+	def close(self):
+		self.commit()
+		self.conn.close()
@@ -1,7 +1,10 @@
 import os
 import re
 import csv
+import sys
+import ctypes
 from collections import defaultdict
+from contextlib import contextmanager
 import warnings
 
 import numpy as np
@@ -23,6 +26,105 @@ class FileUtils:
 			os.makedirs(path)
 			print("Export dir created: " + path)
 
+	@contextmanager
+	def atomicWrite(path, mode = "w", **kwargs):
+		"""
+		Opens a temporary file which replaces the file at path when the block ends. The file stays valid
+		if the script is interrupted and readers never see a partially written file
+		Usage:
+			with FileUtils.atomicWrite(path, encoding="utf8") as f:
+				json.dump(data, f)
+		"""
+		tmp_path = path + ".tmp"
+		try:
+			with open(tmp_path, mode, **kwargs) as f:
+				yield f
+			os.replace(tmp_path, path)
+		finally:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+
+	def getMemoryInfo():
+		"""
+		Memory of this process and of the system
+		:return: dict {"rss_mb": resident memory of this process in MB, "available_gb": free physical memory in GB},
+			None for unknown values
+		"""
+		info = {"rss_mb": None, "available_gb": None}
+		try:
+			if sys.platform == "win32":
+				class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+					_fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong),
+								("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+								("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+								("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+								("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+				class MEMORYSTATUSEX(ctypes.Structure):
+					_fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+								("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+								("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+								("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+								("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+				counters = PROCESS_MEMORY_COUNTERS()
+				counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+				if ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+					info["rss_mb"] = counters.WorkingSetSize / 1024**2
+				status = MEMORYSTATUSEX()
+				status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+				if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+					info["available_gb"] = status.ullAvailPhys / 1024**3
+				return info
+
+			if os.path.exists("/proc/self/statm"):
+				with open("/proc/self/statm") as f:
+					info["rss_mb"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+			else:
+				import resource
+				# Peak of the whole process (macOS reports bytes)
+				info["rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+			if os.path.exists("/proc/meminfo"):
+				# MemAvailable includes the page cache which can be freed
+				with open("/proc/meminfo") as f:
+					for line in f:
+						if line.startswith("MemAvailable:"):
+							info["available_gb"] = int(line.split()[1]) / 1024**2
+			else:
+				info["available_gb"] = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024**3
+		except (OSError, ValueError, AttributeError, ImportError):
+			pass
+		return info
+
+	def scanRecordsDir(path):
+		# Directory structure:
+		# .../
+		#		YYYY-MM-DD_[Field Name]/
+		#			FPLAN/
+		#				IMG_001.JPG
+		#				...
+		# Returns dict records[year][field][date] = record directory
+		records = defaultdict(lambda: defaultdict(dict))
+		for entry in os.scandir(path):
+			if (entry.is_dir()):
+				# Regex checks subdir names and excludes malformatted and "Kalibrierung" / "Kalibartion"
+				match_pattern = re.match(r"(\d{4}\-\d{2}\-\d{2})[\s\_]((?!Kal).+$)", entry.name, re.IGNORECASE) 
+				if (match_pattern):
+					entry_name = match_pattern.group(2)
+					entry_date = match_pattern.group(1)
+					entry_year = entry_date[:4]
+					
+					records[entry_year][entry_name][entry_date] = entry.path # records[name] = date
+		return {year: dict(fields) for year, fields in records.items()}
+
+	def getRecordPhotos(record_path):
+		# Returns the pathes of all jpg images in the mission directories (FPLAN / MEDIA) of a record
+		photos = []
+		for mission in os.scandir(record_path):
+			if(mission.is_dir() and (re.search(r"FPLAN", mission.name) or re.search(r"MEDIA", mission.name))): # only scan mission directorys for files
+				for file in os.scandir(mission.path):
+					if(file.name.rsplit(".", 1)[-1].upper() in ["JPG", "JPEG"]): # only import jpg images
+						photos.append(file.path)
+		return photos
+
 	def name_escape(text):
 		re.sub(r"(_|-)+", " ", text).title().replace(" ", "")
 		return "".join(c for c in text if c.isalnum())
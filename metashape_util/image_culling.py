@@ -0,0 +1,180 @@
+import os
+import csv
+import math
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from metashape_util.exif_utils import ExifUtils, HEADER_READ_SIZE
+from metashape_util.file_cache import FileCache
+
+# Increase when the computed image features change, cached features of older versions are not used
+FEATURE_VERSION = 1
+
+class ImageCulling:
+	"""
+	Removes photos which only increase the processing time before they are imported:
+	- blurred photos: sharpness (variance of the laplacian) far below the other photos of the mission
+	- near duplicates: similar perceptual hash (dHash), taken shortly after another at the same position (hovering)
+	- takeoff / landing: altitude clearly below the mission altitude
+	The features are computed on a downscaled decode in parallel and cached per file.
+	"""
+	def __init__(self, config, cache_path = False, log_path = False):
+		self.ACTIVE = config.getboolean("IMAGE_CULLING", False)
+		self.WORKERS = config.getint("CULL_WORKERS", 8)
+		# Photos with sharpness below this share of the median sharpness of the mission are blurred
+		self.BLUR_RATIO = config.getfloat("CULL_BLUR_RATIO", 0.4)
+		# Near duplicates: hash difference in bits, time difference in seconds and distance in meters
+		self.DUPLICATE_BITS = config.getint("CULL_DUPLICATE_BITS", 4)
+		self.DUPLICATE_SECONDS = config.getfloat("CULL_DUPLICATE_SECONDS", 10)
+		self.DUPLICATE_DISTANCE = config.getfloat("CULL_DUPLICATE_DISTANCE", 1.0)
+		# Photos more than this share below the mission altitude are taken during takeoff or landing
+		self.ALTITUDE_TOLERANCE = config.getfloat("CULL_ALTITUDE_TOLERANCE", 0.15)
+		# Safety limit, if more photos of a mission would be removed the mission is kept completely
+		self.MAX_FRACTION = config.getfloat("CULL_MAX_FRACTION", 0.5)
+
+		self.log_path = log_path
+		self.cache = None
+		if(self.ACTIVE and cache_path):
+			self.cache = FileCache(cache_path, {"version": FEATURE_VERSION}, table = "image_features")
+
+		# Number of removed photos by reason of the last filterPhotos() call
+		self.lastStats = {}
+
+	@staticmethod
+	def getFeatures(path):
+		# Sharpness, perceptual hash and EXIF / XMP header of a photo
+		buf = np.fromfile(path, dtype=np.uint8)
+		features = ExifUtils.parseHeader(buf[:HEADER_READ_SIZE].tobytes())
+		# The jpeg decoder scales the image down while decoding, much faster than a full decode
+		img = cv2.imdecode(buf, cv2.IMREAD_REDUCED_GRAYSCALE_8 | cv2.IMREAD_IGNORE_ORIENTATION)
+		if np.shape(img) == ():
+			features["readable"] = False
+			return features
+		features["readable"] = True
+		features["sharpness"] = float(cv2.Laplacian(img, cv2.CV_64F).var())
+		# dHash: brightness gradients of a 9x8 thumbnail as 64 bit number
+		thumb = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+		bits = (thumb[:, 1:] > thumb[:, :-1]).flatten()
+		features["dhash"] = int("".join("1" if bit else "0" for bit in bits), 2)
+		return features
+
+	def _loadFeatures(self, photos):
+		features = {}
+		if(self.cache):
+			for photo in photos:
+				found, result = self.cache.get(photo)
+				if(found):
+					features[photo] = result
+
+		missing = [photo for photo in photos if photo not in features]
+		with ThreadPoolExecutor(max_workers=max(1, self.WORKERS)) as pool:
+			for photo, result in zip(missing, pool.map(ImageCulling.getFeatures, missing)):
+				features[photo] = result
+				if(self.cache):
+					self.cache.put(photo, result)
+		if(self.cache):
+			self.cache.commit()
+		return features
+
+	def filterPhotos(self, label, photos):
+		"""
+		:param label: chunk label, used in the log
+		:return: list of the photos to import
+		"""
+		self.lastStats = {}
+		if(not self.ACTIVE or len(photos) <= 0):
+			return photos
+
+		features = self._loadFeatures(photos)
+
+		# Missions (FPLAN folders) are flown at different altitudes, every mission is checked on its own
+		missions = defaultdict(list)
+		for photo in photos:
+			missions[os.path.dirname(photo)].append(photo)
+
+		dropped = {} # photo: (reason, value)
+		for mission, mission_photos in missions.items():
+			mission_dropped = self._cullMission(mission_photos, features)
+			if(len(mission_dropped) > len(mission_photos) * self.MAX_FRACTION):
+				print("Warning: culling would remove {} of {} photos in {}, keeping all".format(len(mission_dropped), len(mission_photos), mission))
+				continue
+			dropped.update(mission_dropped)
+
+		for reason, value in dropped.values():
+			self.lastStats[reason] = self.lastStats.get(reason, 0) + 1
+		print("Culling {}: {} of {} photos removed {}".format(label, len(dropped), len(photos), self.lastStats))
+		self._writeLog(label, dropped)
+		return [photo for photo in photos if photo not in dropped]
+
+	def _cullMission(self, photos, features):
+		dropped = {}
+		for photo in photos:
+			if(not features[photo].get("readable", False)):
+				dropped[photo] = ("unreadable", "")
+		remaining = [photo for photo in photos if photo not in dropped]
+
+		# Takeoff and landing: altitude above the takeoff point, from XMP (DJI) or relative to the lowest photo
+		if(all("relative_altitude" in features[photo] for photo in remaining)):
+			altitudes = np.array([features[photo]["relative_altitude"] for photo in remaining], dtype=float)
+		elif(all("altitude" in features[photo] for photo in remaining)):
+			altitudes = np.array([features[photo]["altitude"] for photo in remaining], dtype=float)
+			altitudes -= altitudes.min() if len(altitudes) > 0 else 0
+		else:
+			altitudes = None
+		if(altitudes is not None and len(remaining) >= 5):
+			mission_altitude = np.median(altitudes)
+			for photo, altitude in zip(remaining, altitudes):
+				if(altitude < mission_altitude * (1 - self.ALTITUDE_TOLERANCE)):
+					dropped[photo] = ("altitude", round(float(altitude), 1))
+			remaining = [photo for photo in remaining if photo not in dropped]
+
+		# Blurred photos, compared with the other photos of the mission (sharpness depends on camera and scene)
+		if(len(remaining) >= 5):
+			limit = np.median([features[photo]["sharpness"] for photo in remaining]) * self.BLUR_RATIO
+			for photo in remaining:
+				if(features[photo]["sharpness"] < limit):
+					dropped[photo] = ("blur", round(features[photo]["sharpness"], 1))
+			remaining = [photo for photo in remaining if photo not in dropped]
+
+		# Near duplicates in capture order, of two duplicates the sharper photo is kept
+		remaining.sort(key=lambda photo: (features[photo].get("time", 0), photo))
+		previous = None
+		for photo in remaining:
+			if(previous is not None and self._isDuplicate(features[previous], features[photo])):
+				if(features[photo]["sharpness"] > features[previous]["sharpness"]):
+					dropped[previous] = ("duplicate", os.path.basename(photo))
+				else:
+					dropped[photo] = ("duplicate", os.path.basename(previous))
+					continue
+			previous = photo
+		return dropped
+
+	def _isDuplicate(self, a, b):
+		if(bin(a["dhash"] ^ b["dhash"]).count("1") > self.DUPLICATE_BITS):
+			return False
+		# Similar looking photos of a field are only duplicates if taken at the same time or position
+		if(("time" not in a or "time" not in b) and ("latitude" not in a or "latitude" not in b)):
+			return False
+		if("time" in a and "time" in b and abs(a["time"] - b["time"]) > self.DUPLICATE_SECONDS):
+			return False
+		if("latitude" in a and "latitude" in b):
+			# Distance in meters, local approximation
+			dy = (a["latitude"] - b["latitude"]) * 111320
+			dx = (a["longitude"] - b["longitude"]) * 111320 * math.cos(math.radians(a["latitude"]))
+			if(math.hypot(dx, dy) > self.DUPLICATE_DISTANCE):
+				return False
+		return True
+
+	def _writeLog(self, label, dropped):
+		if(not self.log_path or len(dropped) <= 0):
+			return
+		write_header = not os.path.exists(self.log_path)
+		with open(self.log_path, "a", newline='', encoding="utf8") as f:
+			writer = csv.writer(f, delimiter=";")
+			if(write_header):
+				writer.writerow(["chunk", "photo", "reason", "value"])
+			for photo, (reason, value) in sorted(dropped.items()):
+				writer.writerow([label, photo, reason, value])
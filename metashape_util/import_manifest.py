@@ -0,0 +1,57 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from metashape_util.file_utils import FileUtils
+
+class ImportManifest:
+	"""
+	Persisted list of the imported photos of every chunk (path, size and mtime)
+	Stored as json file next to the project, used to import only new records and photos
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.chunks = {} # chunk label: {"record": record path, "files": {photo path: [size, mtime]}}
+		if os.path.exists(path):
+			with open(path, encoding="utf8") as f:
+				self.chunks = json.load(f).get("chunks", {})
+
+	def save(self):
+		with FileUtils.atomicWrite(self.path, encoding="utf8") as f:
+			json.dump({"chunks": self.chunks}, f, indent=1)
+
+	@staticmethod
+	def scanRecords(records, workers = 8):
+		"""
+		Lists the photos of all record directories in parallel (the network share is slow, not the cpu)
+		:param records: dict {date: record path}
+		:return: dict {date: {photo path: [size, mtime]}}
+		"""
+		def scan(record_path):
+			files = {}
+			for photo in FileUtils.getRecordPhotos(record_path):
+				st = os.stat(photo)
+				files[photo] = [st.st_size, st.st_mtime_ns]
+			return files
+
+		dates = list(records.keys())
+		with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+			return dict(zip(dates, pool.map(scan, [records[date] for date in dates])))
+
+	def getNewPhotos(self, label, files):
+		"""
+		Returns the photos of files not imported to the chunk yet
+		Modified photos (size or mtime changed) are not imported again, the warning lists them
+		"""
+		imported = self.chunks.get(label, {}).get("files", {})
+		new_photos = [photo for photo in files if photo not in imported]
+		modified = [photo for photo in files if photo in imported and imported[photo] != files[photo]]
+		if(len(modified) > 0):
+			print("Warning: {} photos of chunk {} were modified after the import: {}".format(len(modified), label, modified))
+		return sorted(new_photos)
+
+	def addPhotos(self, label, record_path, files):
+		# files: {photo path: [size, mtime]} of the photos imported into the chunk
+		entry = self.chunks.setdefault(label, {"record": record_path, "files": {}})
+		entry["record"] = record_path
+		entry["files"].update(files)
@@ -0,0 +1,111 @@
+import sys
+import threading
+import configparser
+import socketserver
+
+class LocalSmtpServer:
+    """
+    Minimal SMTP server on localhost which keeps the received messages in memory, a stand-in for the mail server
+    to test EmailNotify without network access. No TLS and no authentication, so EmailNotify skips both.
+    Usage:
+        with LocalSmtpServer(reject = 1) as server:
+            # SMTP_SERVER: 127.0.0.1, SMTP_PORT: server.port, SMTP_STARTTLS: off
+            ...
+        server.messages
+    Self test of EmailNotify (queue, retries, connection reuse, digest): python -m metashape_util.local_smtp_server
+    """
+    def __init__(self, host = "127.0.0.1", port = 0, reject = 0):
+        """
+        :param port: 0 chooses a free port, see self.port
+        :param reject: number of messages answered with a temporary error (451) before messages are accepted
+        """
+        self.messages = [] # (sender, recipients, data)
+        self.connections = 0
+        self.reject = reject
+        self._lock = threading.Lock()
+
+        server = self
+        class SmtpHandler(socketserver.StreamRequestHandler):
+            def reply(self, text):
+                self.wfile.write((text + "\r\n").encode("ascii"))
+
+            def handle(self):
+                with server._lock:
+                    server.connections += 1
+                self.reply("220 localhost ESMTP stand-in")
+                sender, recipients = None, []
+                for line in self.rfile:
+                    command = line.decode("utf8", errors="replace").strip()
+                    verb = command[:4].upper()
+                    if verb == "EHLO":
+                        self.reply("250-localhost")
+                        self.reply("250 8BITMIME")
+                    elif verb == "HELO":
+                        self.reply("250 localhost")
+                    elif verb == "MAIL":
+                        sender, recipients = command[10:].strip("<> "), []
+                        self.reply("250 OK")
+                    elif verb == "RCPT":
+                        recipients.append(command[8:].strip("<> "))
+                        self.reply("250 OK")
+                    elif verb == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        data = []
+                        for data_line in self.rfile:
+                            if data_line.rstrip(b"\r\n") == b".":
+                                break
+                            data.append(data_line.decode("utf8", errors="replace"))
+                        with server._lock:
+                            rejected = server.reject > 0
+                            if rejected:
+                                server.reject -= 1
+                            else:
+                                server.messages.append((sender, recipients, "".join(data)))
+                        self.reply("451 Temporary failure, try again" if rejected else "250 OK")
+                    elif verb in ("NOOP", "RSET"):
+                        self.reply("250 OK")
+                    elif verb == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("502 Command not implemented")
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), SmtpHandler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+    # Self test: sends a notification and a digest through EmailNotify, the first attempt is rejected
+    from metashape_util.email_notify import EmailNotify
+
+    with LocalSmtpServer(reject = 1) as server:
+        config = configparser.ConfigParser()
+        config["EmailNotify"] = {
+            "SEND_EMAIL_NOTIFICATION": "on", "SMTP_SERVER": server.host, "SMTP_PORT": str(server.port),
+            "SMTP_USER": "autodem@localhost", "SMTP_PASS": "unused", "TO_EMAIL": "test@localhost",
+            "SMTP_STARTTLS": "off", "EMAIL_RETRIES": "2", "EMAIL_RETRY_DELAY": "0.1", "EMAIL_DIGEST_INTERVAL": "0"
+        }
+        notify = EmailNotify(config["EmailNotify"])
+        notify.project = "self test"
+        notify.notify("AutoDEM self test", "Test message")
+        notify.event("chunk_1", "aligned", "10 of 10 cameras aligned")
+        notify.close(timeout = 10)
+
+    subjects = [line for sender, recipients, data in server.messages for line in data.splitlines() if line.startswith("Subject:")]
+    print("Received {} messages on {} connections: {}".format(len(server.messages), server.connections, subjects))
+    ok = len(server.messages) == 2 and notify.sent == 2 and notify.failed == 0
+    print("Self test " + ("passed" if ok else "FAILED"))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,250 @@
+import os
+import numpy as np
+
+from metashape_util.chunk import ChunkUtils
+
+class OverlapGraph:
+	"""
+	Neighbour graph of the photos from the camera GPS positions (EXIF), photos whose ground areas can overlap are neighbours.
+	- matching: only the pairs of the graph are matched (at most PAIR_MAX_NEIGHBOURS per photo) instead of
+	  the preselection of Metashape, the matching time grows linearly with the number of photos
+	- splitting: chunks with more than SPLIT_MAX_CAMERAS photos are split into overlapping parts,
+	  which are matched and aligned independently and merged afterwards
+	"""
+	def __init__(self, config):
+		self.ACTIVE = config.getboolean("PAIR_PRESELECTION", True)
+		self.MAX_NEIGHBOURS = config.getint("PAIR_MAX_NEIGHBOURS", 30)
+		# Neighbour radius in meters, 0 = twice the ground footprint radius of the photos
+		self.RADIUS = config.getfloat("PAIR_RADIUS", 0)
+		self.SPLIT_MAX_CAMERAS = config.getint("SPLIT_MAX_CAMERAS", 0)
+		# Overlap of the parts in meters, 0 = neighbour radius
+		self.SPLIT_OVERLAP = config.getfloat("SPLIT_OVERLAP", 0)
+
+		# Number of parts of the last alignSplit() call
+		self.lastParts = 0
+
+	@staticmethod
+	def getNeighbourPairs(xy, radius, max_neighbours):
+		"""
+		All pairs of points closer than radius, each point is paired with at most its max_neighbours nearest points
+		The points are sorted into a grid with cells of the size of the radius, only points in the same
+		and the 8 adjacent cells are compared
+		:param xy: numpy array (n, 2) of positions in meters
+		:return: numpy array (m, 2) of index pairs (i < j)
+		"""
+		n = len(xy)
+		if(n < 2 or radius <= 0):
+			return np.empty((0, 2), dtype=np.int64)
+
+		cells = np.floor((xy - xy.min(axis=0)) / radius).astype(np.int64) + 1
+		height = cells[:, 1].max() + 2
+		keys = cells[:, 0] * height + cells[:, 1]
+		order = np.argsort(keys, kind="stable")
+		sorted_keys = keys[order]
+
+		first, second = [], []
+		for dx in (-1, 0, 1):
+			for dy in (-1, 0, 1):
+				query = keys + dx * height + dy
+				start = np.searchsorted(sorted_keys, query, side="left")
+				counts = np.searchsorted(sorted_keys, query, side="right") - start
+				total = counts.sum()
+				if(total <= 0): continue
+				# Expand the ranges [start, start + count) of all points at once
+				offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+				first.append(np.repeat(np.arange(n), counts))
+				second.append(order[np.repeat(start, counts) + offsets])
+		i = np.concatenate(first)
+		j = np.concatenate(second)
+		distances = np.hypot(*(xy[i] - xy[j]).T)
+		keep = (i != j) & (distances <= radius)
+		i, j, distances = i[keep], j[keep], distances[keep]
+
+		# Nearest neighbours of every point
+		order = np.lexsort((distances, i))
+		i, j = i[order], j[order]
+		group_start = np.searchsorted(i, i, side="left")
+		nearest = (np.arange(len(i)) - group_start) < max_neighbours
+
+		pairs = np.sort(np.stack([i[nearest], j[nearest]], axis=1), axis=1)
+		return np.unique(pairs, axis=0)
+
+	@staticmethod
+	def splitTiles(xy, max_size, overlap):
+		"""
+		Splits the points into tiles of at most max_size points (halving along the longer side at the median),
+		every tile also contains the points within overlap meters around it
+		:return: list of index arrays
+		"""
+		cores = []
+		remaining = [np.arange(len(xy))]
+		while remaining:
+			indices = remaining.pop()
+			if(len(indices) <= max_size):
+				cores.append(indices)
+				continue
+			extent = xy[indices].max(axis=0) - xy[indices].min(axis=0)
+			axis = int(np.argmax(extent))
+			order = indices[np.argsort(xy[indices, axis], kind="stable")]
+			remaining += [order[len(order) // 2:], order[:len(order) // 2]]
+
+		tiles = []
+		for core in cores:
+			low = xy[core].min(axis=0) - overlap
+			high = xy[core].max(axis=0) + overlap
+			inside = np.all((xy >= low) & (xy <= high), axis=1)
+			tiles.append(np.flatnonzero(inside))
+		return tiles
+
+	def getLocalPositions(self, chunk, cameras, world_positions = None):
+		"""
+		Positions of the cameras in a local metric frame (east, north, up) around the first camera with position
+		:param world_positions: other geocentric positions to transform into the same frame
+		:return: numpy array (n, 3), NaN for cameras without position
+		"""
+		positions = ChunkUtils.getCameraWorldPositions(chunk, cameras)
+		known = [position for position in positions if position is not None]
+		if(len(known) <= 0):
+			return np.full((len(world_positions or cameras), 3), np.nan)
+		frame = ChunkUtils.getLocalFrame(chunk, chunk.crs.project(known[0]))
+		xyz = []
+		for position in (world_positions or positions):
+			if(position is None):
+				xyz.append([np.nan] * 3)
+			else:
+				p = frame.mulp(position)
+				xyz.append([p.x, p.y, p.z])
+		return np.array(xyz, dtype=float)
+
+	def getRadius(self, chunk, cameras, xyz):
+		"""
+		Neighbour radius in meters: PAIR_RADIUS or twice the median ground footprint radius of the photos,
+		the ground height is taken from the marker reference locations
+		:return: radius or None if unknown
+		"""
+		if(self.RADIUS > 0):
+			return self.RADIUS
+		markers = [chunk.crs.unproject(marker.reference.location) for marker in chunk.markers if marker.reference.location]
+		if(len(markers) <= 0):
+			return None
+		ground_z = np.median(self.getLocalPositions(chunk, cameras, markers)[:, 2])
+		radii = [ChunkUtils.getCameraFootprintRadius(camera, z - ground_z) for camera, z in zip(cameras, xyz[:, 2]) if not np.isnan(z)]
+		radii = [radius for radius in radii if radius]
+		if(len(radii) <= 0):
+			return None
+		return 2 * float(np.median(radii))
+
+	def getPairs(self, chunk, cameras = None):
+		"""
+		Camera pairs to match, photos without GPS position are paired with all other photos
+		:return: list of (camera key, camera key) or None if the graph can not be built (Metashape preselection is used)
+		"""
+		cameras = [camera for camera in (cameras or chunk.cameras) if camera.photo]
+		if(not self.ACTIVE or len(cameras) < 2):
+			return None
+		xyz = self.getLocalPositions(chunk, cameras)
+		radius = self.getRadius(chunk, cameras, xyz)
+		known = np.flatnonzero(~np.isnan(xyz[:, 0]))
+		if(radius is None or len(known) < 2):
+			return None
+
+		pairs = known[self.getNeighbourPairs(xyz[known, :2], radius, self.MAX_NEIGHBOURS)]
+		pairs = [(cameras[a].key, cameras[b].key) for a, b in pairs]
+		missing = np.isnan(xyz[:, 0])
+		for a in np.flatnonzero(missing):
+			pairs += [(cameras[a].key, cameras[b].key) for b in range(len(cameras)) if b != a and not (missing[b] and b < a)]
+		print("Neighbour graph of chunk {}: {} pairs of {} photos, radius {:.0f} m".format(chunk.label, len(pairs), len(cameras), radius))
+		return pairs
+
+	def matchPhotos(self, chunk, match_params, cameras = None, progress = None):
+		# matchPhotos with the pairs of the neighbour graph, existing matches are kept
+		pairs = self.getPairs(chunk, cameras)
+		if(pairs is None):
+			chunk.matchPhotos(**match_params, reset_matches=False, progress=progress)
+		else:
+			chunk.matchPhotos(**match_params, pairs=pairs, generic_preselection=False, reference_preselection=False,
+							  keep_keypoints=True, reset_matches=False, progress=progress)
+		return pairs
+
+	def needsSplit(self, chunk, new_cameras = None):
+		# Only new chunks are split, photos appended to an aligned chunk are aligned incrementally
+		cameras = [camera for camera in chunk.cameras if camera.photo]
+		return (self.SPLIT_MAX_CAMERAS > 0 and len(cameras) > self.SPLIT_MAX_CAMERAS and not new_cameras
+				and not ChunkUtils.areCamerasAligned(chunk) and not ChunkUtils.hasChunkPointCloud(chunk))
+
+	def alignSplit(self, doc, chunk, match_params, progress = None):
+		"""
+		Splits the chunk into overlapping parts, matches and aligns every part, aligns the parts on the shared
+		cameras and merges them. The merged chunk replaces the chunk (same label and meta data, added at the end of the document)
+		:param progress: progress callback of the whole split alignment
+		:return: merged chunk or the chunk itself if it can not be split
+		"""
+		cameras = [camera for camera in chunk.cameras if camera.photo]
+		xyz = self.getLocalPositions(chunk, cameras)
+		radius = self.getRadius(chunk, cameras, xyz)
+		known = np.flatnonzero(~np.isnan(xyz[:, 0]))
+		self.lastParts = 0
+		if(radius is None or len(known) < len(cameras)):
+			print("Warning: chunk {} can not be split (camera positions or ground height unknown)".format(chunk.label))
+			self.matchPhotos(chunk, match_params, progress=self._stepProgress(progress, 0, 2))
+			chunk.alignCameras(progress=self._stepProgress(progress, 1, 2))
+			return chunk
+
+		tiles = self.splitTiles(xyz[:, :2], self.SPLIT_MAX_CAMERAS, self.SPLIT_OVERLAP or radius)
+		print("Splitting chunk {} with {} photos into {} parts".format(chunk.label, len(cameras), len(tiles)))
+		# Matching and alignment of every part and of the merged chunk
+		steps = 2 * len(tiles) + 2
+		parts = []
+		try:
+			for index, tile in enumerate(tiles):
+				part = chunk.copy()
+				part.label = "{} part {}".format(chunk.label, index + 1)
+				parts.append(part)
+				tile_photos = {os.path.normcase(cameras[i].photo.path) for i in tile}
+				part.remove([camera for camera in part.cameras if not camera.photo or os.path.normcase(camera.photo.path) not in tile_photos])
+				self.matchPhotos(part, match_params, progress=self._stepProgress(progress, 2 * index, steps))
+				part.alignCameras(progress=self._stepProgress(progress, 2 * index + 1, steps))
+
+			# The parts share the cameras of the overlap
+			doc.alignChunks(chunks=[part.key for part in parts], reference=parts[0].key, method=2)
+			chunk_count = len(doc.chunks)
+			doc.mergeChunks(chunks=[part.key for part in parts], merge_markers=True, merge_tiepoints=True)
+			merged = doc.chunks[chunk_count]
+		finally:
+			for part in parts:
+				doc.remove(part)
+
+		# Cameras of the overlap exist once per part, the aligned camera is kept
+		kept = {}
+		duplicates = []
+		for camera in merged.cameras:
+			path = os.path.normcase(camera.photo.path) if camera.photo else camera.key
+			if(path not in kept):
+				kept[path] = camera
+			elif(camera.transform and not kept[path].transform):
+				duplicates.append(kept[path])
+				kept[path] = camera
+			else:
+				duplicates.append(camera)
+		merged.remove(duplicates)
+
+		# Connect the parts: match the pairs across the part borders and align the remaining cameras
+		self.matchPhotos(merged, match_params, progress=self._stepProgress(progress, steps - 2, steps))
+		unaligned = ChunkUtils.getUnalignedCameras(merged)
+		if(len(unaligned) > 0):
+			merged.alignCameras(cameras=unaligned, reset_alignment=False, progress=self._stepProgress(progress, steps - 1, steps))
+
+		for key in chunk.meta.keys():
+			merged.meta[key] = chunk.meta[key]
+		merged.enabled = chunk.enabled
+		label = chunk.label
+		doc.remove(chunk)
+		merged.label = label
+		self.lastParts = len(tiles)
+		return merged
+
+	def _stepProgress(self, progress, step, steps):
+		# Progress callback of one step, reports the progress of all steps
+		if(progress is None):
+			return None
+		return lambda percent: progress((step + percent / 100) / steps * 100)
@@ -0,0 +1,113 @@
+import os
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from metashape_util.exif_utils import ExifUtils
+from metashape_util.file_utils import FileUtils
+
+class PhotoIndex:
+	"""
+	Table of the capture time, position and gimbal angles of all photos, read from the EXIF / XMP header
+	Stored as columns in a numpy .npz file. Only new or modified photos are read again.
+	Missing values are NaN. Usage:
+		index = PhotoIndex(path)
+		index.update(photos)
+		rows = index.lookup(photos)
+		index.column("time")[rows]
+	"""
+	# Header values stored as float columns, see ExifUtils.readHeader()
+	COLUMNS = ["time", "latitude", "longitude", "altitude", "relative_altitude", "gimbal_yaw", "gimbal_pitch"]
+
+	def __init__(self, path = False):
+		self.path = path
+		self.data = {"path": np.array([], dtype=str), "size": np.array([], dtype=np.int64), "mtime": np.array([], dtype=np.int64)}
+		for column in self.COLUMNS:
+			self.data[column] = np.array([], dtype=np.float64)
+		if(path and os.path.exists(path)):
+			with np.load(path) as stored:
+				if(all(column in stored for column in self.data)):
+					self.data = {column: stored[column] for column in self.data}
+		self._rows = {p: i for i, p in enumerate(self.data["path"])}
+
+	def save(self):
+		with FileUtils.atomicWrite(self.path, "wb") as f:
+			np.savez(f, **self.data)
+
+	def column(self, name):
+		return self.data[name]
+
+	def lookup(self, photos):
+		# Row numbers of the photos, photos have to be indexed with update() before
+		return np.array([self._rows[photo] for photo in photos], dtype=np.int64)
+
+	def update(self, photos, workers = 16):
+		"""
+		Reads the header of all new or modified photos in parallel (the network share is slow, not the cpu)
+		:return: number of read photos
+		"""
+		stats = {}
+		for photo in photos:
+			st = os.stat(photo)
+			stats[photo] = (st.st_size, st.st_mtime_ns)
+		changed = [photo for photo in photos if photo not in self._rows
+				   or (self.data["size"][self._rows[photo]], self.data["mtime"][self._rows[photo]]) != stats[photo]]
+		if(len(changed) <= 0):
+			return 0
+
+		with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+			headers = list(pool.map(ExifUtils.readHeader, changed))
+
+		# Modified photos are replaced, new photos appended
+		keep = np.ones(len(self.data["path"]), dtype=bool)
+		keep[[self._rows[photo] for photo in changed if photo in self._rows]] = False
+		new_data = {
+			"path": np.array(changed, dtype=str),
+			"size": np.array([stats[photo][0] for photo in changed], dtype=np.int64),
+			"mtime": np.array([stats[photo][1] for photo in changed], dtype=np.int64)
+		}
+		for column in self.COLUMNS:
+			new_data[column] = np.array([header.get(column, np.nan) for header in headers], dtype=np.float64)
+		self.data = {column: np.concatenate([self.data[column][keep], new_data[column]]) for column in self.data}
+		self._rows = {p: i for i, p in enumerate(self.data["path"])}
+		return len(changed)
+
+	def getCaptureDates(self, photos):
+		# Capture date YYYY-MM-DD of the photos (camera clock), None for photos without capture time
+		times = self.column("time")[self.lookup(photos)]
+		return [None if np.isnan(t) else datetime.fromtimestamp(t, timezone.utc).strftime("%Y-%m-%d") for t in times]
+
+	def getFlights(self, photos, max_gap_seconds = 120, max_jump_meters = 300):
+		"""
+		Splits the photos into flights: a new flight starts after a pause or a jump of the position
+		:return: array of flight numbers (0, 1, ...) in the order of photos
+		"""
+		rows = self.lookup(photos)
+		if(len(rows) <= 0):
+			return np.array([], dtype=np.int64)
+		times = self.column("time")[rows]
+		lat = self.column("latitude")[rows]
+		lon = self.column("longitude")[rows]
+
+		# Capture order, photos without time at the end
+		order = np.argsort(np.where(np.isnan(times), np.inf, times), kind="stable")
+		gaps = np.diff(times[order]) > max_gap_seconds
+		# Distance between consecutive photos in meters, local approximation
+		dy = np.diff(lat[order]) * 111320
+		dx = np.diff(lon[order]) * 111320 * np.cos(np.radians(lat[order][1:]))
+		jumps = np.hypot(dx, dy) > max_jump_meters
+
+		flights = np.empty(len(rows), dtype=np.int64)
+		flights[order] = np.concatenate([[0], np.cumsum(gaps | jumps)])
+		return flights
+
+	def groupByDate(self, photos, default_date):
+		"""
+		Groups the photos by capture date, photos without capture time get the default date
+		:return: dict {date: [photos]}
+		"""
+		groups = {}
+		for photo, date in zip(photos, self.getCaptureDates(photos)):
+			groups.setdefault(date or default_date, []).append(photo)
+		return groups
@@ -0,0 +1,87 @@
+from metashape_util.file_utils import FileUtils
+
+class ProcessingProfiles:
+	"""
+	Processing settings of a chunk, read from the sections [Profile.<name>] in config.ini
+	With PROCESSING_PROFILE: auto the profile is chosen per chunk from the camera count, the image
+	resolution and the free memory. The chosen profile is stored in the chunk meta data and kept on restarts.
+	"""
+	# Ordered from highest to lowest quality
+	NAMES = ["ultra", "standard", "fast"]
+	META_KEY = "AutoDEM/profile"
+
+	def __init__(self, config):
+		self.PROFILE = config.get("Profiles", "PROCESSING_PROFILE", fallback="auto").strip().lower()
+		self.AUTO_MAX = config.get("Profiles", "PROFILE_AUTO_MAX", fallback="ultra").strip().lower()
+		# Share of the free memory the depth maps may use
+		self.MEMORY_USAGE = config.getfloat("Profiles", "PROFILE_MEMORY_USAGE", fallback=0.7)
+		# Estimated memory in GB per processed megapixel (image pixels / depth downscale²) of the depth maps
+		self.GB_PER_MEGAPIXEL = config.getfloat("Profiles", "PROFILE_GB_PER_MEGAPIXEL", fallback=0.008)
+
+		self.profiles = {}
+		for name in self.NAMES:
+			section = "Profile." + name
+			self.profiles[name] = {
+				"min_cameras": config.getint(section, "MIN_CAMERAS", fallback=0),
+				"match": {
+					"downscale": config.getint(section, "MATCH_DOWNSCALE", fallback=1),
+					"keypoint_limit": config.getint(section, "KEYPOINT_LIMIT", fallback=40000),
+					"tiepoint_limit": config.getint(section, "TIEPOINT_LIMIT", fallback=0)
+				},
+				"depth": {
+					"downscale": config.getint(section, "DEPTH_DOWNSCALE", fallback=1),
+					"filter_mode": config.get(section, "DEPTH_FILTER", fallback="ModerateFiltering").strip()
+				},
+				# 0 = resolution chosen by Metashape
+				"dem": {"resolution": config.getfloat(section, "DEM_RESOLUTION", fallback=0)},
+				"ortho": {"resolution": config.getfloat(section, "ORTHO_RESOLUTION", fallback=0)}
+			}
+
+	@staticmethod
+	def getAvailableMemory():
+		"""Free physical memory in GB, None if unknown"""
+		return FileUtils.getMemoryInfo()["available_gb"]
+
+	def estimateMemory(self, name, cameras, megapixels):
+		# Estimated memory of the depth maps in GB
+		downscale = self.profiles[name]["depth"]["downscale"]
+		return cameras * megapixels / downscale**2 * self.GB_PER_MEGAPIXEL
+
+	def select(self, chunk, fallback = None, keep = False):
+		"""
+		Returns the profile of the chunk. A fixed PROCESSING_PROFILE is used for all chunks, with auto the
+		profile stored in the chunk meta data is kept, otherwise fallback or the automatic selection is used
+		:param fallback: profile of chunks without stored profile, instead of the automatic selection
+		:param keep: keep the stored profile also if PROCESSING_PROFILE is changed, e.g. for chunks already matched
+		:return: [name, profile]
+		"""
+		name = chunk.meta[self.META_KEY] if self.META_KEY in chunk.meta.keys() else None
+		if(keep and name in self.profiles):
+			if(self.PROFILE in self.profiles and self.PROFILE != name):
+				print("Chunk {} keeps profile {} instead of {}, invalidate the stage match to process it again".format(chunk.label, name, self.PROFILE))
+		elif(self.PROFILE in self.profiles):
+			name = self.PROFILE
+		elif(name not in self.profiles):
+			name = fallback if fallback in self.profiles else self.selectAuto(chunk)
+		chunk.meta[self.META_KEY] = name
+		return name, self.profiles[name]
+
+	def selectAuto(self, chunk):
+		cameras = [camera for camera in chunk.cameras if camera.sensor]
+		if(len(cameras) <= 0):
+			return self.NAMES[-1]
+		megapixels = sum(camera.sensor.width * camera.sensor.height for camera in cameras) / len(cameras) / 1e6
+		memory = self.getAvailableMemory()
+
+		# Highest quality profile allowed for this chunk size whose depth maps fit into the free memory
+		candidates = self.NAMES[self.NAMES.index(self.AUTO_MAX):] if self.AUTO_MAX in self.NAMES else self.NAMES
+		for name in candidates:
+			if(len(cameras) < self.profiles[name]["min_cameras"]):
+				continue
+			if(memory is not None and self.estimateMemory(name, len(cameras), megapixels) > memory * self.MEMORY_USAGE):
+				continue
+			print("Selected profile {} for chunk {}: {} cameras, {:.1f} MP, {} GB free memory".format(
+				name, chunk.label, len(cameras), megapixels, "unknown" if memory is None else round(memory, 1)))
+			return name
+		print("Warning: depth maps of chunk {} may not fit into the free memory, using profile {}".format(chunk.label, self.NAMES[-1]))
+		return self.NAMES[-1]
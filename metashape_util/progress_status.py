@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metashape_util.file_utils import FileUtils
+
+class ProgressStatus:
+	"""
+	Live status of an unattended run: current chunk, stage, percent, throughput and estimated end of the stage.
+	The status is written to a json file (at most every WRITE_INTERVAL seconds) and served as json on
+	http://<host>:<port>/ if a port is given. progress() is used as progress callback of the Metashape calls.
+	Usage:
+		with status.stage(chunk, "dense"):
+			chunk.buildDenseCloud(progress = status.progress)
+	"""
+	WRITE_INTERVAL = 2
+	# Number of finished stages listed in the status
+	HISTORY_LENGTH = 50
+	# Status values of the running stage
+	STAGE_KEYS = ["chunk", "stage", "items", "percent", "stage_started", "photos_per_second", "eta_seconds", "eta"]
+
+	def __init__(self, path = False, port = 0, host = "127.0.0.1", job = ""):
+		self.path = path
+		self._lock = threading.Lock()
+		self._last_write = 0
+		self._stage_start = None
+		self._last_change = time.time()
+		self.status = {
+			"job": job,
+			"pid": os.getpid(),
+			"state": "running",
+			"started": datetime.now().isoformat(timespec="seconds"),
+			"chunk": None,
+			"stage": None,
+			"items": None,
+			"percent": None,
+			"history": []
+		}
+
+		self.server = None
+		if(port > 0):
+			self._startServer(host, port)
+		self.write(force = True)
+
+	def _startServer(self, host, port):
+		status = self
+		class StatusHandler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = json.dumps(status.snapshot(), indent=1).encode("utf8")
+				self.send_response(200)
+				self.send_header("Content-Type", "application/json")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				# Requests are not printed to the Metashape console
+				pass
+
+		try:
+			self.server = ThreadingHTTPServer((host, port), StatusHandler)
+		except OSError as e:
+			# e.g. port used by another run of the batch mode
+			print("Warning: status server could not be started on port {}: {}".format(port, e))
+			return
+		self.server.daemon_threads = True
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		print("Status available on http://{}:{}/".format(host, port))
+
+	def snapshot(self):
+		# Copy of the status with the current durations
+		with self._lock:
+			status = dict(self.status, history=list(self.status["history"]))
+			now = time.time()
+			status["updated"] = datetime.now().isoformat(timespec="seconds")
+			if(self._stage_start is not None):
+				status["stage_elapsed"] = round(now - self._stage_start)
+				# Seconds without progress, long stalls need a look at the workstation
+				status["seconds_without_progress"] = round(now - self._last_change)
+		return status
+
+	def write(self, force = False):
+		if(not self.path or (not force and time.time() - self._last_write < self.WRITE_INTERVAL)):
+			return
+		self._last_write = time.time()
+		try:
+			with FileUtils.atomicWrite(self.path, encoding="utf8") as f:
+				json.dump(self.snapshot(), f, indent=1)
+		except OSError as e:
+			# e.g. the file is opened by a reader on windows, the next call writes it again
+			print("Warning: status file could not be written: {}".format(e))
+
+	@contextmanager
+	def stage(self, chunk, stage, items = None):
+		"""
+		Marks the stage of the chunk as running
+		:param items: number of processed photos for the throughput, default: cameras of the chunk
+		"""
+		label = chunk.label if hasattr(chunk, "label") else chunk
+		if(items is None and hasattr(chunk, "cameras")):
+			items = len(chunk.cameras)
+		with self._lock:
+			outer = ({key: self.status.get(key) for key in self.STAGE_KEYS}, self._stage_start, self._last_change)
+			self.status.update({"chunk": label, "stage": stage, "items": items, "percent": 0.0,
+								"stage_started": datetime.now().isoformat(timespec="seconds"),
+								"photos_per_second": None, "eta_seconds": None, "eta": None})
+			self._stage_start = time.time()
+			self._last_change = self._stage_start
+		self.write(force = True)
+		try:
+			yield
+		finally:
+			with self._lock:
+				self.status["history"].append({"chunk": label, "stage": stage,
+											   "duration": round(time.time() - self._stage_start, 1),
+											   "finished": datetime.now().isoformat(timespec="seconds")})
+				del self.status["history"][:-self.HISTORY_LENGTH]
+				# Stages can be nested (e.g. saving the project inside a stage), the outer stage is running again
+				self.status.update(outer[0])
+				self._stage_start, self._last_change = outer[1], outer[2]
+			self.write(force = True)
+
+	def setItems(self, items):
+		# Number of photos of the running stage if it is only known after the stage started (e.g. after a prefilter)
+		with self._lock:
+			if(self._stage_start is not None):
+				self.status["items"] = items
+
+	def progress(self, percent):
+		# Progress callback of the Metashape functions, percent from 0 to 100
+		with self._lock:
+			if(self._stage_start is None):
+				return
+			now = time.time()
+			if(percent != self.status["percent"]):
+				self._last_change = now
+			self.status["percent"] = round(float(percent), 2)
+			elapsed = now - self._stage_start
+			if(percent > 0 and elapsed > 0):
+				remaining = elapsed * (100 - percent) / percent
+				self.status["eta_seconds"] = round(remaining)
+				self.status["eta"] = datetime.fromtimestamp(now + remaining).isoformat(timespec="seconds")
+				if(self.status["items"]):
+					self.status["photos_per_second"] = round(self.status["items"] * percent / 100 / elapsed, 3)
+		self.write()
+
+	def finish(self, state = "finished", message = None):
+		with self._lock:
+			self.status.update({"state": state, "chunk": None, "stage": None, "percent": None,
+								"finished": datetime.now().isoformat(timespec="seconds")})
+			if(message):
+				self.status["message"] = message
+			self._stage_start = None
+		self.write(force = True)
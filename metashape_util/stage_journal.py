@@ -0,0 +1,117 @@
+import os
+import json
+import time
+from datetime import datetime
+from contextlib import nullcontext
+
+from metashape_util.file_utils import FileUtils
+
+class StageJournal:
+	"""
+	Records the completed processing stages of every chunk in a json file
+	A restarted script skips exactly the completed stages. The stages depend on each other in the order
+	of STAGES: running or invalidating a stage invalidates all following stages of the chunk.
+	Usage:
+		journal.run(chunk, "dense", lambda: chunk.buildDenseCloud(), params = {"point_colors": True})
+	"""
+	STAGES = ["import", "match", "align", "gcp", "optimize", "depth", "dense", "dem", "ortho", "export"]
+
+	def __init__(self, path, save_document = None, measure = None):
+		"""
+		:param save_document: function saving the project, called before a stage is recorded as completed
+			so the journal never lists results which are not saved in the project
+		:param measure: context manager measure(chunk, stage, params) run around every stage, see StageMetrics
+		"""
+		self.path = path
+		self.save_document = save_document
+		self.measure = measure or (lambda chunk, stage, params = None: nullcontext())
+		self.chunks = {} # chunk label: {stage: {"finished": iso time, "duration": seconds, "params": {...}}}
+		# Chunks whose stages were run or invalidated by the journal, the results of all other chunks
+		# (processed before the journal existed) are detected by probing the chunk
+		self.tracked = set()
+		if os.path.exists(path):
+			with open(path, encoding="utf8") as f:
+				data = json.load(f)
+			self.chunks = data.get("chunks", {})
+			self.tracked = set(data.get("tracked", []))
+
+	def save(self):
+		with FileUtils.atomicWrite(self.path, encoding="utf8") as f:
+			json.dump({"stages": self.STAGES, "tracked": sorted(self.tracked), "chunks": self.chunks}, f, indent=1)
+
+	def _label(self, chunk):
+		return chunk.label if hasattr(chunk, "label") else chunk
+
+	def isDone(self, chunk, stage, params = None):
+		"""
+		True if the stage is completed, with params given also the parameters have to match the recorded ones
+		"""
+		entry = self.chunks.get(self._label(chunk), {}).get(stage)
+		if entry is None:
+			return False
+		# Stages recorded by adopt() have unknown parameters, they match any parameters
+		return params is None or entry.get("params") is None or entry.get("params") == params
+
+	def markDone(self, chunk, stage, duration = 0, params = None):
+		self.chunks.setdefault(self._label(chunk), {})[stage] = {
+			"finished": datetime.now().isoformat(timespec="seconds"),
+			"duration": duration,
+			"params": params or {}
+		}
+		self.save()
+
+	def adopt(self, chunk, stage, probe):
+		"""
+		Records the stage and all previous stages as completed if probe() finds the result of the stage in a chunk
+		processed before the journal existed, e.g. an exported file. The chunk is not processed again.
+		:return: True if the stages were recorded
+		"""
+		label = self._label(chunk)
+		if(label in self.tracked or self.isDone(chunk, stage) or not probe()):
+			return False
+		print("Stage {} found in chunk {} (not in journal), skipping all stages up to it".format(stage, label))
+		stages = self.chunks.setdefault(label, {})
+		for name in self.STAGES[:self.STAGES.index(stage) + 1]:
+			if(name not in stages):
+				stages[name] = {"finished": datetime.now().isoformat(timespec="seconds"), "duration": 0, "params": None}
+		self.save()
+		return True
+
+	def invalidate(self, chunk, stage):
+		# Removes the stage and all following stages of the chunk
+		# Existing results in the chunk are not probed anymore, the stages are run again
+		self.tracked.add(self._label(chunk))
+		stages = self.chunks.get(self._label(chunk), {})
+		removed = [name for name in self.STAGES[self.STAGES.index(stage):] if stages.pop(name, None) is not None]
+		if(len(removed) > 0):
+			print("Invalidated stages of chunk {}: {}".format(self._label(chunk), ", ".join(removed)))
+		self.save()
+
+	def run(self, chunk, stage, func, params = None, probe = None):
+		"""
+		Runs func() if the stage is not completed with the same params and records it as completed
+		:param probe: function returning True if the result of the stage already exists in the chunk,
+			only used for chunks whose stages were never run by the journal
+		:return: True if func was run
+		"""
+		label = self._label(chunk)
+		if(self.isDone(chunk, stage, params)):
+			print("Stage {} already finished in chunk {}, skipping".format(stage, label))
+			return False
+
+		if(label not in self.tracked and probe is not None and probe()):
+			print("Stage {} found in chunk {} (not in journal), skipping".format(stage, label))
+			self.markDone(chunk, stage, params = params)
+			return False
+
+		# The following stages depend on the result of this one
+		self.invalidate(chunk, stage)
+		print("Running stage {} in chunk {}...".format(stage, label))
+		start = time.time()
+		with self.measure(chunk, stage, params):
+			func()
+		if(self.save_document is not None):
+			with self.measure(chunk, "save"):
+				self.save_document()
+		self.markDone(chunk, stage, time.time() - start, params)
+		return True
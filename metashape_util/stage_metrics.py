@@ -0,0 +1,83 @@
+import time
+import json
+import threading
+from contextlib import contextmanager
+
+from metashape_util.file_utils import FileUtils
+
+class StageMetrics:
+	"""
+	Measures wall time, cpu time and peak memory (RSS) of the processing stages of every chunk.
+	The values are written to the stats as Stage/<stage>/wall_s, cpu_s, peak_rss_mb and params,
+	a stage measured several times (e.g. saving the project) is summed up. Usage:
+		with metrics.measure(chunk, "optimize", params):
+			chunk.optimizeCameras()
+	"""
+	# Interval in seconds of the memory sampling while a stage runs
+	SAMPLE_INTERVAL = 0.5
+
+	def __init__(self, stats):
+		self.stats = stats
+		self.totals = {} # chunk label: {stage: {"wall_s", "cpu_s", "peak_rss_mb"}}
+
+	@staticmethod
+	def getMemoryUsage():
+		"""Resident memory (RSS) of this process in MB, None if unknown"""
+		return FileUtils.getMemoryInfo()["rss_mb"]
+
+	@contextmanager
+	def measure(self, chunk, stage, params = None):
+		label = chunk.label if hasattr(chunk, "label") else chunk
+		# Metashape releases memory after a stage, the peak is sampled in background while the stage runs
+		peak = [self.getMemoryUsage()]
+		stop = threading.Event()
+		def sample():
+			while not stop.wait(self.SAMPLE_INTERVAL):
+				current = self.getMemoryUsage()
+				if current is not None and (peak[0] is None or current > peak[0]):
+					peak[0] = current
+		sampler = threading.Thread(target=sample, daemon=True)
+		sampler.start()
+
+		wall_start = time.perf_counter()
+		# process_time includes the cpu time of all threads, also those of Metashape
+		cpu_start = time.process_time()
+		try:
+			yield
+		finally:
+			wall = time.perf_counter() - wall_start
+			cpu = time.process_time() - cpu_start
+			stop.set()
+			sampler.join()
+			current = self.getMemoryUsage()
+			if current is not None and (peak[0] is None or current > peak[0]):
+				peak[0] = current
+			self._record(label, stage, wall, cpu, peak[0], params)
+
+	def _record(self, label, stage, wall, cpu, peak, params):
+		total = self.totals.setdefault(label, {}).setdefault(stage, {"wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": None})
+		total["wall_s"] += wall
+		total["cpu_s"] += cpu
+		if peak is not None:
+			total["peak_rss_mb"] = max(peak, total["peak_rss_mb"] or 0)
+
+		for key, value in total.items():
+			if value is not None:
+				self.stats.setValue(label, "Stage/" + stage + "/" + key, round(value, 2))
+		if params:
+			self.stats.setValue(label, "Stage/" + stage + "/params", json.dumps(params, sort_keys=True, default=str))
+		print("Stage {} of chunk {}: {:.1f} s wall, {:.1f} s cpu, peak memory {}".format(
+			stage, label, wall, cpu, "unknown" if peak is None else "{:.0f} MB".format(peak)))
+
+	def getDominantStage(self, chunk):
+		"""
+		Stage with the longest wall time of the chunk in this run
+		:return: [stage, share of the measured wall time] or [None, 0]
+		"""
+		label = chunk.label if hasattr(chunk, "label") else chunk
+		stages = self.totals.get(label, {})
+		if len(stages) <= 0:
+			return None, 0
+		stage = max(stages, key=lambda name: stages[name]["wall_s"])
+		total = sum(values["wall_s"] for values in stages.values())
+		return stage, stages[stage]["wall_s"] / total if total > 0 else 0
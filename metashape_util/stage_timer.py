@@ -0,0 +1,71 @@
+import time
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+import numpy as np
+
+class StageTimer:
+    """
+    Collects durations of named processing stages and event counters
+    Usage:
+        with timer.stage("decode"):
+            ...
+        timer.count("images")
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.samples = defaultdict(list)
+            self.counters = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, duration):
+        with self._lock:
+            self.samples[name].append(duration)
+
+    def count(self, name, n = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def pop(self):
+        """Returns the collected data as plain dict (can be sent between processes) and resets the timer"""
+        with self._lock:
+            data = {"samples": dict(self.samples), "counters": dict(self.counters)}
+            self.samples = defaultdict(list)
+            self.counters = defaultdict(int)
+        return data
+
+    def merge(self, data):
+        """Adds data returned by pop() of another timer"""
+        with self._lock:
+            for name, durations in data["samples"].items():
+                self.samples[name] += durations
+            for name, n in data["counters"].items():
+                self.counters[name] += n
+
+    def summary(self):
+        """
+        Aggregates of all stages and counters
+        :return: dict {"time/[stage]/total": seconds, ".../mean", ".../p95", "count/[counter]": n}
+        """
+        result = {}
+        with self._lock:
+            for name, durations in sorted(self.samples.items()):
+                durations = np.array(durations)
+                result["time/" + name + "/total"] = float(durations.sum())
+                result["time/" + name + "/mean"] = float(durations.mean())
+                result["time/" + name + "/p95"] = float(np.percentile(durations, 95))
+            for name, n in sorted(self.counters.items()):
+                result["count/" + name] = n
+        return result
@@ -1,50 +1,155 @@
 import os
 import csv
-import pandas as pd
+import json
+import time
+import sqlite3
+
+from metashape_util.file_utils import FileUtils
 
 class Stats:
-    def __init__(self, csv_path):
+    """
+    Metrics of the chunks (durations, counts, errors). Every value is appended as a typed record to an SQLite
+    database next to the csv file, several processes can write at the same time.
+    saveFile() exports the latest value of every chunk and metric to the csv file (one row per chunk).
+    """
+    # Values are written to the database after this number of new values
+    COMMIT_INTERVAL = 50
+
+    def __init__(self, csv_path, db_path = None):
         self.csv_path = csv_path
-        if not os.path.exists(csv_path):
-            with open(csv_path, "w") as csv_file:
-                writer = csv.writer(csv_file, delimiter=";")
-                writer.writerow(["Chunk Name"])
-            
-        self.df = pd.read_csv(self.csv_path, index_col='Chunk Name', delimiter=";", decimal=",")
+        self.db_path = db_path or os.path.splitext(csv_path)[0] + ".sqlite"
+        # New values not yet written to the database
+        self._pending = []
+
+        migrate = not os.path.exists(self.db_path)
+        # Writers of other processes lock the database, wait for them instead of failing
+        self.conn = sqlite3.connect(self.db_path, timeout=60)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS metrics (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chunk TEXT NOT NULL,
+                name TEXT NOT NULL,
+                value TEXT NOT NULL,
+                time REAL NOT NULL,
+                pid INTEGER NOT NULL
+            )""")
+        self.conn.commit()
+        # Values of the csv files written before the database existed are kept
+        if migrate and os.path.exists(csv_path):
+            self._importCsv()
 
     def setValue(self, row, col, value):
-        if(hasattr(row, "label")): 
+        if(hasattr(row, "label")):
             index = row.label
-        else: 
+        else:
             index = row
-        self.df.loc[index, col] = self.castValue(value)
+        self._pending.append((index, col, json.dumps(self.castValue(value)), time.time(), os.getpid()))
+        if len(self._pending) >= self.COMMIT_INTERVAL:
+            self.commit()
 
     def castValue(self, value):
-        return str(value).replace(".", ",")
-    
-    def getValue(self, row, col, value):
-        return self.df.loc[row, col]
-	
+        # numpy numbers and other values which are not stored as json are converted
+        if hasattr(value, "item"):
+            value = value.item()
+        if isinstance(value, str):
+            # Metashape meta data stores numbers as text
+            return self._parseNumber(value, value)
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        return str(value)
+
+    def _parseNumber(self, text, default):
+        for parse in (int, float):
+            try:
+                return parse(text)
+            except ValueError:
+                pass
+        return default
+
+    def getValue(self, row, col, value = None):
+        # Latest value of the chunk and metric, value if not found
+        index = row.label if hasattr(row, "label") else row
+        self.commit()
+        found = self.conn.execute("SELECT value FROM metrics WHERE chunk = ? AND name = ? ORDER BY id DESC LIMIT 1",
+                                  (index, col)).fetchone()
+        return value if found is None else json.loads(found[0])
+
+    def commit(self):
+        # The values are written in one short transaction, other processes are only blocked while writing
+        if len(self._pending) <= 0:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT INTO metrics (chunk, name, value, time, pid) VALUES (?, ?, ?, ?, ?)", self._pending)
+        self._pending = []
+
+    def getTable(self):
+        """
+        Latest value of every chunk and metric
+        :return: [rows, columns] rows is a dict {chunk: {metric: value}} in order of the first value
+        """
+        self.commit()
+        rows = {}
+        columns = {}
+        for chunk, name, value in self.conn.execute("SELECT chunk, name, value FROM metrics ORDER BY id"):
+            rows.setdefault(chunk, {})[name] = json.loads(value)
+            columns[name] = True
+        return rows, list(columns)
+
+    def formatValue(self, value):
+        # Decimal comma like the former pandas export
+        if value is None:
+            return ""
+        if isinstance(value, float):
+            return str(value).replace(".", ",")
+        return str(value)
+
     def saveFile(self):
-        self.df.to_csv(self.csv_path, sep=";", decimal=",", )
+        # Exports the csv file
+        rows, columns = self.getTable()
+        with FileUtils.atomicWrite(self.csv_path, newline='', encoding="utf8") as csv_file:
+            writer = csv.writer(csv_file, delimiter=";")
+            writer.writerow(["Chunk Name"] + columns)
+            for chunk, values in rows.items():
+                writer.writerow([chunk] + [self.formatValue(values.get(column)) for column in columns])
+
+    def _importCsv(self):
+        with open(self.csv_path, newline='', encoding="utf8", errors="replace") as csv_file:
+            for row in csv.DictReader(csv_file, delimiter=";"):
+                chunk = row.pop("Chunk Name", None)
+                if not chunk: continue
+                for name, text in row.items():
+                    if name and text:
+                        self.setValue(chunk, name, self._parseNumber(text.replace(",", "."), text))
+        self.commit()
+
+    def getMeta(self, item, key):
+        # Meta data value of the chunk or a product, None if the product or the value does not exist
+        if item is None or key not in item.meta.keys():
+            return None
+        return item.meta[key]
 
     def saveChunkMeta(self, chunk):
-        # Extract chunk meta data and save to file
-        # chunk object
-        self.setValue(chunk.label, "Chunk/camera_count", len(chunk.cameras))
-        self.setValue(chunk.label, "Chunk/marker_count", len(chunk.markers))
-        self.setValue(chunk.label, "Chunk/OptimizeCameras/sigma0", chunk.meta["OptimizeCameras/sigma0"])
-        self.setValue(chunk.label, "Chunk/AlignCameras/duration", chunk.meta["AlignCameras/duration"])
-        # point cloud meta
-        self.setValue(chunk.label, "PointCloud/MatchPhotos/duration", chunk.point_cloud.meta["MatchPhotos/duration"])
-        self.setValue(chunk.label, "PointCloud/point_count", len(chunk.point_cloud.points))
-        # dense cloud meta
-        self.setValue(chunk.label, "DenseCloud/duration", chunk.dense_cloud.meta["BuildDenseCloud/duration"])
-        self.setValue(chunk.label, "DenseCloud/resolution", chunk.dense_cloud.meta["BuildDenseCloud/resolution"])
-        # depth maps meta
-        self.setValue(chunk.label, "DepthMaps/duration", chunk.depth_maps.meta["BuildDepthMaps/duration"])
-        # orthomosaic meta
-        self.setValue(chunk.label, "Orthomosaic/duration", chunk.orthomosaic.meta["BuildOrthomosaic/duration"])
-        # DEM meta
-        self.setValue(chunk.label, "BuildDem/duration", chunk.elevations[0].meta["BuildDem/duration"])
-        self.setValue(chunk.label, "BuildDem/resolution", chunk.elevations[0].meta["BuildDem/resolution"])
\ No newline at end of file
+        # Extract chunk meta data and save to file, missing products are skipped
+        values = {
+            # chunk object
+            "Chunk/camera_count": len(chunk.cameras),
+            "Chunk/marker_count": len(chunk.markers),
+            "Chunk/OptimizeCameras/sigma0": self.getMeta(chunk, "OptimizeCameras/sigma0"),
+            "Chunk/AlignCameras/duration": self.getMeta(chunk, "AlignCameras/duration"),
+            # point cloud meta
+            "PointCloud/MatchPhotos/duration": self.getMeta(chunk.point_cloud, "MatchPhotos/duration"),
+            "PointCloud/point_count": len(chunk.point_cloud.points) if chunk.point_cloud else None,
+            # dense cloud meta
+            "DenseCloud/duration": self.getMeta(chunk.dense_cloud, "BuildDenseCloud/duration"),
+            "DenseCloud/resolution": self.getMeta(chunk.dense_cloud, "BuildDenseCloud/resolution"),
+            # depth maps meta
+            "DepthMaps/duration": self.getMeta(chunk.depth_maps, "BuildDepthMaps/duration"),
+            # orthomosaic meta
+            "Orthomosaic/duration": self.getMeta(chunk.orthomosaic, "BuildOrthomosaic/duration"),
+            # DEM meta
+            "BuildDem/duration": self.getMeta(chunk.elevation, "BuildDem/duration"),
+            "BuildDem/resolution": self.getMeta(chunk.elevation, "BuildDem/resolution")
+        }
+        for col, value in values.items():
+            if value is not None:
+                self.setValue(chunk.label, col, value)